@@ -12,10 +12,48 @@ import unittest
 import sys
 import re
 import random
+import math
+import threading
+import os
+import tempfile
+import time
+import json
+import argparse
+import tracemalloc
 
 # Additional modules
 import bisect
 import array
+import functools
+import operator
+import itertools
+import collections
+import io
+import mmap
+import pickle
+import struct
+import contextlib
+import copy
+import weakref
+import concurrent.futures
+from multiprocessing import shared_memory
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Value of an aggregate over no items
+_EMPTY = object()
+
+# Signature and version of the dumped Fastlist layout
+_MAGIC = b"FASTLIST"
+_LAYOUT = 1
+
+# Aggregates known by name: (fold, op)
+_AGGREGATES = {
+    "sum": (sum, operator.add), "min": (min, min), "max": (max, max),
+    "count": (len, operator.add)}
 
 ###############################################################################
 # Fastlist Class
@@ -34,21 +72,721 @@ class Arrq(array.array):
         return super().__new__(self, "q", l)
 
 
+class Nparr(object):
+    """ Growable NumPy array with the list interface used by Fastlist """
+
+    dtype = None
+
+    def __init__(self, l=[]):
+        if numpy is None:
+            raise ImportError("NumPy array sublists need the numpy module")
+        self._data = self._values(l).copy()
+        self._n = len(self._data)
+
+    def _values(self, l):
+        if isinstance(l, Nparr):
+            return l.view()
+        if isinstance(l, (list, tuple, array.array, memoryview,
+                          numpy.ndarray)):
+            return numpy.asarray(l, dtype=self.dtype)
+        return numpy.fromiter(l, dtype=self.dtype)
+
+    def _reserve(self, n):
+        if n > len(self._data):
+            data = numpy.empty(max(n, 2 * len(self._data), 8), self.dtype)
+            data[:self._n] = self._data[:self._n]
+            self._data = data
+
+    def _index(self, i):
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError("Array index out of range")
+        return i
+
+    def view(self):
+        """ NumPy view of the items, valid until the next update """
+        return self._data[:self._n]
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return type(self)(self.view()[index])
+        return self._data.item(self._index(index))
+
+    def __setitem__(self, index, obj):
+        if not isinstance(index, slice):
+            self._data[self._index(index)] = obj
+            return
+        (start, stop, step) = index.indices(self._n)
+        if step != 1:
+            self.view()[index] = self._values(obj)
+            return
+        stop = max(start, stop)
+        self._data = numpy.concatenate(
+            (self._data[:start], self._values(obj), self._data[stop:self._n]))
+        self._n = len(self._data)
+
+    def __delitem__(self, index):
+        if not isinstance(index, slice):
+            index = self._index(index)
+        self._data = numpy.delete(self.view(), index)
+        self._n = len(self._data)
+
+    def __iter__(self):
+        return iter(self.view().tolist())
+
+    def __contains__(self, obj):
+        return bool((self.view() == obj).any())
+
+    def index(self, obj):
+        hits = numpy.flatnonzero(self.view() == obj)
+        if len(hits) == 0:
+            raise ValueError("{} is not in array".format(obj))
+        return int(hits[0])
+
+    def count(self, obj):
+        return int((self.view() == obj).sum())
+
+    def __add__(self, other):
+        values = (self.view(), self._values(other))
+        return type(self)(numpy.concatenate(values))
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, self.view().tolist())
+
+    def insert(self, index, obj):
+        index = min(max(index + self._n if index < 0 else index, 0), self._n)
+        self._reserve(self._n + 1)
+        self._data[index+1:self._n+1] = self._data[index:self._n]
+        self._data[index] = obj
+        self._n += 1
+
+    def pop(self, index=-1):
+        index = self._index(index)
+        item = self._data.item(index)
+        self._data[index:self._n-1] = self._data[index+1:self._n]
+        self._n -= 1
+        return item
+
+    def append(self, obj):
+        self._reserve(self._n + 1)
+        self._data[self._n] = obj
+        self._n += 1
+
+    def extend(self, iter):
+        values = self._values(iter)
+        self._reserve(self._n + len(values))
+        self._data[self._n:self._n+len(values)] = values
+        self._n += len(values)
+
+
+class Npq(Nparr):
+    """ NumPy array of signed 64 bit int """
+    dtype = "int64"
+
+
+class Npd(Nparr):
+    """ NumPy array of 64 bit float """
+    dtype = "float64"
+
+
+# Sublist bases a dumped list can name
+_BASES = {cls.__name__: cls for cls in (list, Arrl, Arrq, Npq, Npd)}
+
+
+class Fenwick(object):
+    """ Binary indexed tree of sublist lengths """
+
+    def __init__(self, l=[]):
+        self._tree = [0] + list(l)
+        self.total = sum(self._tree)
+        for i in range(1, len(self._tree)):
+            j = i + (i & -i)
+            if j < len(self._tree):
+                self._tree[j] += self._tree[i]
+
+    def __len__(self):
+        return len(self._tree) - 1
+
+    def add(self, i, delta):
+        """ Add delta to the i-th value """
+        self.total += delta
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def append(self, value):
+        """ Add a new value to the end """
+        i = len(self._tree)
+        low = self.prefix(i - 1) - self.prefix(i - (i & -i))
+        self._tree.append(value + low)
+        self.total += value
+
+    def prefix(self, i):
+        """ Sum of the first i values """
+        result = 0
+        while i > 0:
+            result += self._tree[i]
+            i -= i & -i
+        return result
+
+    def search(self, index):
+        """ Return (i, offset) of the index-th unit in the values """
+        i = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            j = i + step
+            if j < len(self._tree) and self._tree[j] <= index:
+                i = j
+                index -= self._tree[j]
+            step >>= 1
+        return (i, index)
+
+
+class Segtree(object):
+    """ Segment tree of values combined with an associative operation """
+
+    def __init__(self, l, op):
+        self._op = op
+        self._n = len(l)
+        self._tree = [_EMPTY] * self._n + list(l)
+        for i in range(self._n - 1, 0, -1):
+            self._tree[i] = self.combine(self._tree[2*i], self._tree[2*i+1])
+
+    def combine(self, a, b):
+        if a is _EMPTY:
+            return b
+        if b is _EMPTY:
+            return a
+        return self._op(a, b)
+
+    def set(self, i, value):
+        i += self._n
+        self._tree[i] = value
+        while i > 1:
+            i >>= 1
+            self._tree[i] = self.combine(self._tree[2*i], self._tree[2*i+1])
+
+    def query(self, i, j):
+        """ Combined values in the [i, j) range """
+        left = right = _EMPTY
+        i += self._n
+        j += self._n
+        while i < j:
+            if i & 1:
+                left = self.combine(left, self._tree[i])
+                i += 1
+            if j & 1:
+                j -= 1
+                right = self.combine(self._tree[j], right)
+            i >>= 1
+            j >>= 1
+        return self.combine(left, right)
+
+
+class RWLock(object):
+    """ Reentrant readers-writer lock, waiting writers block new readers """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._waiting = 0
+        self._writer = None
+        self._local = threading.local()
+
+    def held(self):
+        """ The current thread holds the lock in any mode """
+        return (self._writer == threading.get_ident() or
+                getattr(self._local, "reads", 0) > 0)
+
+    def acquire_read(self):
+        """ Take the lock shared, True if this call has to release it """
+        if self.held():
+            return False
+        with self._cond:
+            while self._writer is not None or self._waiting:
+                self._cond.wait()
+            self._readers += 1
+        self._local.reads = 1
+        return True
+
+    def release_read(self):
+        self._local.reads = 0
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def read(self):
+        taken = self.acquire_read()
+        try:
+            yield
+        finally:
+            if taken:
+                self.release_read()
+
+    @contextlib.contextmanager
+    def write(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        if getattr(self._local, "reads", 0):
+            raise RuntimeError("No upgrade of a read lock to the write lock")
+        with self._cond:
+            self._waiting += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting -= 1
+            self._writer = me
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
+
+
+def _np_view(seq):
+    # NumPy view of an array sublist without copying
+    if isinstance(seq, Nparr):
+        return seq.view()
+    return numpy.frombuffer(seq, seq.typecode)
+
+
+def _buffer(lst):
+    # Memoryview of the items of an array sublist
+    if isinstance(lst, (Nparr, _Mapped, _Page)):
+        lst = lst.view()
+    return memoryview(lst)
+
+
+def _from_buffer(base, view):
+    # Base sublist copied from a typed memoryview
+    lst = base()
+    if isinstance(lst, array.array):
+        lst.frombytes(view.cast("B"))
+        return lst
+    return base(view)
+
+
+def _json_safe(obj):
+    # Whether JSON gives obj back with the same value and types
+    if obj is None or type(obj) in (str, int, float, bool):
+        return True
+    if type(obj) is list:
+        return all(map(_json_safe, obj))
+    if type(obj) is dict:
+        return all(type(k) is str and _json_safe(v) for (k, v) in obj.items())
+    return False
+
+
+class _Mapped(object):
+    """ Read only sublist kept in a buffer until it is accessed """
+
+    __slots__ = ("_view",)
+
+    def __init__(self, view):
+        self._view = view
+
+    def __len__(self):
+        return len(self._view)
+
+    def __iter__(self):
+        return iter(self._view)
+
+    def view(self):
+        return self._view
+
+
+class _Lazylists(list):
+    """ Sublists loaded from their _Mapped buffers on first access. Once
+    all are loaded the owner list gets a plain list of them instead """
+
+    def __init__(self, l, base, owner=None):
+        super().__init__(l)
+        self._base = base
+        self._owner = None if owner is None else weakref.ref(owner)
+        self._left = sum(isinstance(lst, _Mapped) for lst in self)
+
+    def _drop(self, index):
+        # Entries at the index are removed or replaced
+        lsts = list.__getitem__(self, index)
+        if not isinstance(index, slice):
+            lsts = [lsts]
+        self._left -= sum(isinstance(lst, _Mapped) for lst in lsts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return _Lazylists(list.__getitem__(self, index), self._base)
+        lst = list.__getitem__(self, index)
+        if isinstance(lst, _Mapped):
+            lst = _from_buffer(self._base, lst.view())
+            list.__setitem__(self, index, lst)
+            self._left -= 1
+            owner = self._owner and self._owner()
+            if not self._left and owner is not None and (
+                    owner._lists is self and owner._key is None):
+                owner._lists = owner._keys = list(self)
+        return lst
+
+    def __setitem__(self, index, obj):
+        self._drop(index)
+        list.__setitem__(self, index, obj)
+
+    def __delitem__(self, index):
+        self._drop(index)
+        list.__delitem__(self, index)
+
+
+class _Page(object):
+    """ Sublist kept in memory as lst or at pos of the page file """
+
+    __slots__ = ("_pages", "pos", "cap", "n", "lst", "dirty")
+
+    def __init__(self, pages, lst):
+        self._pages = pages
+        (self.pos, self.cap, self.n) = (0, 0, 0)
+        (self.lst, self.dirty) = (lst, 1)
+
+    def __len__(self):
+        return self.n if self.lst is None else len(self.lst)
+
+    def __iter__(self):
+        return iter(self.view())
+
+    def view(self):
+        if self.lst is not None:
+            return _buffer(self.lst)
+        return self._pages._read(self)
+
+
+# Page files open in this process: path -> _Pagedlists
+_PAGE_FILES = weakref.WeakValueDictionary()
+
+
+class _Pagedlists(list):
+    """ Sublists paged to a memory mapped file with an LRU memory cache """
+
+    def __init__(self, l, base, path=None, cache=64, page=1024):
+        super().__init__()
+        try:
+            self._format = _buffer(base()).format
+        except TypeError:
+            raise RuntimeError("Paged sublists need the array base")
+        self._base = base
+        self._itemsize = struct.calcsize(self._format)
+        self._page = page
+        self._size = max(cache, 4)
+        self._cache = collections.OrderedDict()
+        self._free = collections.defaultdict(list)
+        self._end = 0
+        self._path = path and os.path.abspath(path)
+        if self._path in _PAGE_FILES:
+            raise RuntimeError("Page file {} is in use".format(path))
+        if self._path:
+            _PAGE_FILES[self._path] = self
+        self._file = open(path, "w+b") if path else tempfile.TemporaryFile()
+        self._file.truncate(mmap.PAGESIZE)
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        for lst in l:
+            list.append(self, self._new(lst))
+
+    def _new(self, lst):
+        page = _Page(self, lst)
+        self._cache_in(page)
+        return page
+
+    def _cache_in(self, page):
+        self._cache[page] = None
+        self._cache.move_to_end(page)
+        while len(self._cache) > self._size:
+            page = self._cache.popitem(last=False)[0]
+            if page.dirty:
+                self._store(page)
+            page.lst = None
+
+    def _read(self, page):
+        start = page.pos
+        data = self._mm[start:start + page.n * self._itemsize]
+        return memoryview(data).cast(self._format)
+
+    def _store(self, page):
+        n = len(page.lst)
+        if n > page.cap:
+            self._release(page)
+            page.cap = -(-n // self._page) * self._page
+            page.pos = self._alloc(page.cap)
+        data = _buffer(page.lst).cast("B")
+        self._mm[page.pos:page.pos + len(data)] = data
+        (page.n, page.dirty) = (n, 0)
+
+    def _alloc(self, cap):
+        if self._free[cap]:
+            return self._free[cap].pop()
+        pos = self._end
+        self._end += cap * self._itemsize
+        if self._end > len(self._mm):
+            self._mm.resize(max(self._end, len(self._mm) * 2))
+        return pos
+
+    def _release(self, page):
+        if page.cap:
+            self._free[page.cap].append(page.pos)
+            page.cap = 0
+
+    def _drop(self, pages):
+        for page in pages:
+            self._cache.pop(page, None)
+            self._release(page)
+            page.lst = None
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list.__getitem__(self, index)
+        page = list.__getitem__(self, index)
+        if page.lst is None:
+            page.lst = _from_buffer(self._base, self._read(page))
+        self._cache_in(page)
+        return page.lst
+
+    def __setitem__(self, index, obj):
+        if not isinstance(index, slice):
+            page = list.__getitem__(self, index)
+            (page.lst, page.dirty) = (obj, 1)
+            self._cache_in(page)
+            return
+        self._drop(list.__getitem__(self, index))
+        list.__setitem__(self, index, [self._new(lst) for lst in obj])
+
+    def __delitem__(self, index):
+        pages = list.__getitem__(self, index)
+        self._drop(pages if isinstance(index, slice) else [pages])
+        list.__delitem__(self, index)
+
+    def insert(self, index, lst):
+        list.insert(self, index, self._new(lst))
+
+    def mark(self, index):
+        """ Sublist at index will be updated in place """
+        list.__getitem__(self, index).dirty = 1
+
+    def resident(self):
+        """ Number of sublists held in memory """
+        return len(self._cache)
+
+    def close(self):
+        if self._path and _PAGE_FILES.get(self._path) is self:
+            del _PAGE_FILES[self._path]
+        self._drop(list.__iter__(self))
+        self._mm.close()
+        self._file.close()
+
+
+def _gallop(seq, x, lo, right=0):
+    # Bisect seq from lo with exponentially growing steps
+    step = 1
+    hi = lo
+    while hi < len(seq) and (x >= seq[hi] if right else x > seq[hi]):
+        lo = hi + 1
+        hi += step
+        step *= 2
+    if right:
+        return bisect.bisect_right(seq, x, lo, min(hi, len(seq)))
+    return bisect.bisect_left(seq, x, lo, min(hi, len(seq)))
+
+
+def _combine_runs(ka, va, kb, vb, count, keyed):
+    # Items and keys keeping count(na, nb) items of each run of equal keys
+    # of two sorted flat lists, galloping over the stretches one side has
+    if count is operator.add:
+        # Timsort merges two sorted runs in one linear pass
+        if not keyed:
+            items = sorted(va + vb)
+            return (items, items)
+        (keys, items) = (ka + kb, va + vb)
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        return ([items[i] for i in order], [keys[i] for i in order])
+    (keep_a, keep_b) = (count(1, 0) > 0, count(0, 1) > 0)
+    items = []
+    keys = [] if keyed else items
+    (i, j, la, lb) = (0, 0, len(ka), len(kb))
+    while i < la and j < lb:
+        (x, y) = (ka[i], kb[j])
+        if x < y:
+            k = i + 1
+            if k < la and ka[k] < y:
+                k = _gallop(ka, y, k)
+            if keep_a:
+                items.extend(va[i:k])
+                if keyed:
+                    keys.extend(ka[i:k])
+            i = k
+        elif y < x:
+            k = j + 1
+            if k < lb and kb[k] < x:
+                k = _gallop(kb, x, k)
+            if keep_b:
+                items.extend(vb[j:k])
+                if keyed:
+                    keys.extend(kb[j:k])
+            j = k
+        else:
+            (ia, jb) = (i + 1, j + 1)
+            if ia < la and not x < ka[ia]:
+                ia = _gallop(ka, x, ia, right=1)
+            if jb < lb and not y < kb[jb]:
+                jb = _gallop(kb, y, jb, right=1)
+            n = count(ia - i, jb - j)
+            na = min(n, ia - i)
+            items.extend(va[i:i+na])
+            items.extend(vb[j:j+n-na])
+            if keyed:
+                keys.extend(ka[i:i+na])
+                keys.extend(kb[j:j+n-na])
+            (i, j) = (ia, jb)
+    if keep_a:
+        items.extend(va[i:])
+        if keyed:
+            keys.extend(ka[i:])
+    if keep_b:
+        items.extend(vb[j:])
+        if keyed:
+            keys.extend(kb[j:])
+    return (items, keys)
+
+
+# Public operations timed by the lists with the statistics enabled
+_TIMED_OPS = (
+    "insert", "append", "extend", "pop", "insort", "insort_left",
+    "insort_many", "add", "index", "count", "remove", "discard",
+    "remove_range", "popleft", "appendleft", "aggregate", "aggregate_range",
+    "irange", "islice", "bisect_many", "count_many", "contains_many",
+    "as_list", "lower_bound", "upper_bound", "merge", "union",
+    "intersection", "difference", "symmetric_difference", "__getitem__",
+    "__setitem__", "__delitem__", "__contains__", "__iter__",
+    "__reversed__")
+_TIMED = {}
+
+
+def _timer(name, method):
+    # Method wrapper adding its calls and run time to the list statistics
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+        if self._stats is None:
+            return method(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            t = self._times.setdefault(name, [0, 0.0])
+            t[0] += 1
+            t[1] += time.perf_counter() - start
+    return timed
+
+
+def _timed_class(cls):
+    # Subclass of cls timing the public operations, made once per class.
+    # Lists without statistics keep cls and pay nothing for the timing
+    if "_untimed" in cls.__dict__:
+        return cls
+    if cls not in _TIMED:
+        ns = {name: _timer(name, getattr(cls, name))
+              for name in _TIMED_OPS if hasattr(cls, name)}
+        ns["_untimed"] = cls
+        ns["__reduce__"] = lambda self: (
+            object.__new__, (cls,), self.__getstate__())
+        _TIMED[cls] = type(cls.__name__, (cls,), ns)
+    return _TIMED[cls]
+
+
+def _picklable(obj):
+    # Whether obj can be sent to a worker process
+    try:
+        pickle.dumps(obj)
+    except Exception:
+        return False
+    return True
+
+
+def _sort_chunk(args):
+    # Process pool worker: sorted chunk of the items
+    (chunk, key) = args
+    return sorted(chunk, key=key)
+
+
+def _sort_shared(args):
+    # Process pool worker: sort a slice of the shared memory array in place
+    (name, fmt, lo, hi) = args
+    shm = shared_memory.SharedMemory(name)
+    try:
+        with shm.buf.cast(fmt) as view, view[lo:hi] as chunk:
+            if numpy is not None:
+                numpy.asarray(chunk).sort()
+            else:
+                chunk[:] = array.array(fmt, sorted(chunk))
+    finally:
+        shm.close()
+
+
 class Fastlist(object):
     """ Fastlist representation """
 
-    def __init__(self, l=[], load=5000, sorted=0, base=list):
+    def __init__(self, l=[], load=5000, sorted=0, base=list, indexed=0,
+                 key=None, keybase=list, adaptive=0, stats=0, hashed=0):
+        if key is not None and not sorted:
+            raise RuntimeError("Key function needs the sorted list")
+        if hashed and sorted:
+            raise RuntimeError("Hash index is for the unsorted list only")
+        if adaptive and not isinstance(adaptive, tuple):
+            adaptive = (64, 1 << 16)
+        if adaptive:
+            load = min(max(load, adaptive[0]), adaptive[1])
+        self._adaptive = adaptive
+        self._mix = [0, 0, 0]
+        self._tune = 0
+        self._rechunk_at = None
+        self._stats = collections.Counter() if stats else None
+        self._hook = stats if callable(stats) else None
+        self._times = {}
         self._load = load
         self._sorted = sorted
         self._base = base
+        self._key = key
+        self._keybase = base if key is None else keybase
+        self._indexed = indexed or sorted
+        self._fw = None
+        self._version = 0
+        self._aggs = []
+        self._anames = {}
+        self._avals = []
+        self._atrees = None
+        self._adirty = set()
+        self._cow = set()
+        self._where = {} if hashed else None
+        self._tokens = []
+        self._tokgen = itertools.count()
+        (self._tokpos, self._tokver) = ({}, -1)
         self._lists = []
+        self._keys = self._lists if key is None else []
         self._starts = []
-        self._mins = self._base()
+        self._head = 0
+        self._mins = self._keybase()
+        self._cursors = {}
+        self._cursor = None
         self._insert_list(0)
-        self._irev = 0
-        self._ii = 0
-        self._il = 0
         self.extend(l)
+        if stats:
+            self.__class__ = _timed_class(type(self))
 
     def _index_location(self, index):
         if len(self._lists[0]) == 0:
@@ -57,38 +795,199 @@ class Fastlist(object):
             return (0, 0)
         if index == -1:
             return (len(self._lists) - 1, len(self._lists[-1]) - 1)
-        if self._sorted:
-            raise RuntimeError("No index access to the sorted list, exc 0, -1")
         length = len(self)
         if index < 0:
             index = length + index
         if index >= length:
             raise IndexError("List index out of range")
+        if self._indexed:
+            if self._stats is not None:
+                self._count("fenwick_searches")
+            return self._fenwick().search(index)
+        if self._stats is not None:
+            self._count("bisects")
+        index += self._head
         il = bisect.bisect_right(self._starts, index) - 1
         return (il, index - self._starts[il])
 
+    def _start(self, il):
+        if il == 0:
+            return 0
+        if self._indexed:
+            return self._fenwick().prefix(il)
+        return self._starts[il] - self._head
+
+    def _fenwick(self):
+        if self._fw is None:
+            if self._stats is not None:
+                self._count("fenwick_rebuilds")
+            self._fw = Fenwick([len(l) for l in self._lists])
+        return self._fw
+
+    def _count(self, event, num=1):
+        # Statistics counter, the hook is called on every event
+        self._stats[event] += num
+        if self._hook is not None:
+            self._hook(event, num)
+
+    def _hash_add(self, il, items):
+        # Count items in the hash index under the token of sublist il
+        (where, t) = (self._where, self._tokens[il])
+        for obj in items:
+            tokens = where.get(obj)
+            if tokens is None:
+                where[obj] = {t: 1}
+            else:
+                tokens[t] = tokens.get(t, 0) + 1
+
+    def _hash_check(self, items):
+        # Unhashable items fail before any sublist changes
+        if self._where is not None:
+            for obj in items:
+                hash(obj)
+
+    def _hash_del(self, il, items):
+        (where, t) = (self._where, self._tokens[il])
+        for obj in items:
+            tokens = where[obj]
+            if tokens[t] == 1:
+                del tokens[t]
+                if not tokens:
+                    del where[obj]
+            else:
+                tokens[t] -= 1
+
+    def _hash_move(self, src, dst, items):
+        self._hash_del(src, items)
+        self._hash_add(dst, items)
+
+    def _token_pos(self):
+        # Sublist position of every hash index token, rebuilt once after
+        # the sublist layout changes
+        if self._tokver != self._version:
+            self._tokpos = {t: il for (il, t) in enumerate(self._tokens)}
+            self._tokver = self._version
+        return self._tokpos
+
+    def _rehash(self):
+        # Rebuild the hash index, one new token per sublist
+        self._tokens = [next(self._tokgen) for lst in self._lists]
+        self._where = {}
+        for il in range(len(self._lists)):
+            self._hash_add(il, self._lists[il])
+
+    def _track(self, cursor):
+        # Keep the cursor at its item over the edits, until it is dropped
+        (cursors, key) = (self._cursors, id(cursor))
+        cursors[key] = weakref.ref(
+            cursor, lambda ref: cursors.pop(key, None))
+
+    def _moved(self, pos, n):
+        # Items inserted (n > 0) or deleted (n < 0) at the pos position
+        length = len(self)
+        for ref in list(self._cursors.values()):
+            cursor = ref()
+            if cursor is not None:
+                cursor._moved(pos, n, length)
+
+    def _merged(self, il, keys):
+        # Sorted keys about to be merged into sublist il, right of equals
+        (start, old) = (self._start(il), self._keys[il])
+        for k in reversed(keys):
+            self._moved(start + bisect.bisect_right(old, k), 1)
+
+    def _own(self, il):
+        # Copy the sublist shared with a snapshot before an in-place update
+        if self._cow:
+            if id(self._lists[il]) in self._cow:
+                self._cow.discard(id(self._lists[il]))
+                self._lists[il] = self._lists[il][:]
+            if id(self._keys[il]) in self._cow:
+                self._cow.discard(id(self._keys[il]))
+                self._keys[il] = self._keys[il][:]
+
+    def _touch(self, il):
+        # Sublist il changed its items
+        if self._aggs:
+            self._adirty.add(il)
+
+    def _shift(self, il, delta):
+        # Sublist il changed its length by delta
+        self._touch(il)
+        if self._indexed:
+            if self._fw is not None:
+                self._fw.add(il, delta)
+        elif not self._sorted:
+            # Starts are offset by the head, so the starts up to il can
+            # move instead of the ones after it. Head updates are O(1)
+            if il * 2 < len(self._starts):
+                (lo, hi) = (0, il + 1)
+                (self._head, delta) = (self._head - delta, -delta)
+            else:
+                (lo, hi) = (il + 1, len(self._starts))
+            if self._stats is not None:
+                self._count("starts_fixups", hi - lo)
+            for j in range(lo, hi):
+                self._starts[j] += delta
+
+    def _agg_flush(self):
+        # Drop the aggregates of changed sublists before the layout changes
+        for il in self._adirty:
+            self._avals[il] = None
+        self._adirty.clear()
+        self._atrees = None
+
     def _insert_list(self, il):
+        self._version += 1
+        if self._aggs:
+            self._agg_flush()
+            self._avals.insert(il, None)
         self._lists.insert(il, self._base())
+        if self._where is not None:
+            self._tokens.insert(il, next(self._tokgen))
+        if self._key is not None:
+            self._keys.insert(il, self._keybase())
         if self._sorted:
             if len(self._mins) != 0:
-                self._mins.insert(il, self._lists[il-1][-1])
-        else:
+                self._mins.insert(il, self._keys[il-1][-1])
+        if self._indexed:
+            if self._fw is not None and il == len(self._fw):
+                self._fw.append(0)
+            else:
+                self._fw = None
+        elif not self._sorted:
             if il == 0:
-                self._starts.insert(il, 0)
+                self._starts.insert(il, self._head)
             else:
                 start = self._starts[il-1] + len(self._lists[il-1])
                 self._starts.insert(il, start)
 
-    def _del_list(self, il):
-        del self._lists[il]
+    def _del_list(self, il, num=1):
+        self._version += 1
+        if self._aggs:
+            self._agg_flush()
+            del self._avals[il:il+num]
+        if self._where is not None:
+            for j in range(il, il + num):
+                self._hash_del(j, self._lists[j])
+            del self._tokens[il:il+num]
+        del self._lists[il:il+num]
+        if self._key is not None:
+            del self._keys[il:il+num]
         if self._sorted:
-            del self._mins[il]
-        else:
-            del self._starts[il]
+            del self._mins[il:il+num]
+        if self._indexed:
+            self._fw = None
+        elif not self._sorted:
+            del self._starts[il:il+num]
+            if il == 0 and len(self._starts):
+                self._head = self._starts[0]
 
     def _rebalance(self, il):
         illen = len(self._lists[il])
         if illen >= self._load * 2:
+            if self._stats is not None:
+                self._count("splits")
             self._insert_list(il)
             self._even_lists(il)
         if illen <= self._load * 0.2:
@@ -98,91 +997,1215 @@ class Fastlist(object):
                 self._even_lists(il)
 
     def _even_lists(self, il):
+        self._version += 1
+        self._touch(il)
+        self._touch(il+1)
         tot = len(self._lists[il]) + len(self._lists[il+1])
+        if self._stats is not None:
+            self._count("merges" if tot < self._load else "evens")
         if tot < self._load * 1:
+            self._own(il)
+            if self._where is not None:
+                self._hash_add(il, self._lists[il+1])
             self._lists[il] += self._lists[il+1]
+            if self._key is not None:
+                self._keys[il] += self._keys[il+1]
             self._del_list(il+1)
             if self._sorted:
-                self._mins[il] = self._lists[il][0]
+                self._mins[il] = self._keys[il][0]
         else:
             half = tot//2
+            moved = half - len(self._lists[il])
+            if self._where is not None:
+                if moved > 0:
+                    self._hash_move(il+1, il, self._lists[il+1][:moved])
+                else:
+                    self._hash_move(il, il+1, self._lists[il][half:])
             ltot = self._lists[il] + self._lists[il+1]
             self._lists[il] = ltot[:half]
             self._lists[il+1] = ltot[half:]
+            if self._key is not None:
+                ktot = self._keys[il] + self._keys[il+1]
+                self._keys[il] = ktot[:half]
+                self._keys[il+1] = ktot[half:]
             if self._sorted:
-                self._mins[il] = self._lists[il][0]
-                self._mins[il+1] = self._lists[il+1][0]
-            else:
+                self._mins[il] = self._keys[il][0]
+                self._mins[il+1] = self._keys[il+1][0]
+            if self._indexed:
+                if self._fw is not None:
+                    self._fw.add(il, moved)
+                    self._fw.add(il+1, -moved)
+            elif not self._sorted:
+                if self._stats is not None:
+                    self._count("starts_fixups")
                 self._starts[il+1] = self._starts[il] + len(self._lists[il])
 
+    def _split_list(self, il):
+        # Cut an overgrown sublist into even pieces of at most load size
+        lst = self._lists[il]
+        if len(lst) < self._load * 2:
+            self._rebalance(il)
+            return
+        num = -(-len(lst) // self._load)
+        cuts = [len(lst) * k // num for k in range(num + 1)]
+        chunks = [lst[cuts[k]:cuts[k+1]] for k in range(num)]
+        if self._stats is not None:
+            self._count("splits", num - 1)
+        if self._where is not None:
+            tokens = [self._tokens[il]]
+            for k in range(1, num):
+                tokens.append(next(self._tokgen))
+                self._tokens.insert(il + k, tokens[k])
+                self._hash_move(il, il + k, chunks[k])
+        self._version += 1
+        if self._aggs:
+            self._agg_flush()
+            self._avals[il:il+1] = [None] * num
+        self._lists[il:il+1] = chunks
+        if self._key is not None:
+            keys = self._keys[il]
+            chunks = [keys[cuts[k]:cuts[k+1]] for k in range(num)]
+            self._keys[il:il+1] = chunks
+        if self._sorted:
+            self._mins[il:il+1] = self._keybase([c[0] for c in chunks])
+        if self._indexed:
+            self._fw = None
+        elif not self._sorted:
+            for k in range(1, num):
+                self._starts.insert(il + k, self._starts[il] + cuts[k])
+
+    def _adapt(self):
+        # Retune the load now and then, re-chunk a sublist per update
+        self._mix[1] += 1
+        self._tune -= 1
+        if self._tune <= 0:
+            self._retune()
+        if self._rechunk_at is not None:
+            self._rechunk()
+
+    def _retune(self):
+        # Load toward 4*sqrt(n), larger for index access, scans and arrays,
+        # smaller for updates. Changes under 1.5 times are ignored
+        (index, update, scan) = self._mix
+        total = max(index + update + scan, 1)
+        factor = 4 * 2 ** ((index + scan - update) / total)
+        if self._base is not list:
+            factor *= 2
+        (lo, hi) = self._adaptive
+        target = int(min(max(factor * math.sqrt(len(self)), lo), hi))
+        if not self._load / 1.5 < target < self._load * 1.5:
+            self._load = target
+            self._rechunk_at = 0
+        self._mix = [0, 0, 0]
+        self._tune = max(len(self._lists), 64)
+
+    def _rechunk(self):
+        # Bring the sublist at the sweep position within the load bounds
+        il = self._rechunk_at
+        if il >= len(self._lists):
+            self._rechunk_at = None
+            return
+        n = len(self._lists[il])
+        if n >= self._load * 2:
+            self._split_list(il)
+        elif n <= self._load * 0.2 and il + 1 < len(self._lists):
+            self._even_lists(il)
+            if len(self._lists[il]) <= self._load * 0.2:
+                return
+        self._rechunk_at = il + 1
+
+    def _lay_out(self, items, keys=None):
+        # Replace the content with items cut into even load sized sublists
+        if keys is None:
+            keys = items if self._key is None else list(map(self._key, items))
+        num = -(-len(items) // self._load)
+        cuts = [len(items) * k // max(num, 1) for k in range(num + 1)]
+        self._set_lists(
+            [self._base(items[cuts[k]:cuts[k+1]]) for k in range(num)],
+            None if self._key is None else [
+                self._keybase(keys[cuts[k]:cuts[k+1]]) for k in range(num)])
+
+    def _set_lists(self, lists, keys=None):
+        # Replace the content with the non empty sublists and their keys
+        self.clear()
+        if len(lists) == 0:
+            return
+        self._version += 1
+        self._lists[:] = lists
+        if self._key is not None:
+            self._keys[:] = keys
+        self._mins = self._keybase(
+            [k[0] for k in (lists if keys is None else keys)])
+        self._starts = Arrl(itertools.accumulate(
+            itertools.chain([0], map(len, lists[:-1]))))
+        self._head = 0
+        if self._where is not None:
+            self._rehash()
+        if self._aggs:
+            self._avals = [None] * len(lists)
+            self._atrees = None
+
+    def _empty_like(self):
+        result = object.__new__(type(self))
+        Fastlist.__init__(
+            result, load=self._load, sorted=self._sorted, base=self._base,
+            indexed=self._indexed, key=self._key, keybase=self._keybase,
+            adaptive=self._adaptive,
+            stats=self._stats is not None and (self._hook or 1),
+            hashed=self._where is not None)
+        return result
+
+    def _key_of(self, obj):
+        return obj if self._key is None else self._key(obj)
+
     def _obj_location(self, obj, l=0):
+        return self._key_location(self._key_of(obj), l)
+
+    def _key_location(self, k, l=0):
         if not self._sorted:
             raise RuntimeError("No by-value access to an unsorted list")
+        if self._stats is not None:
+            self._count("bisects", 1 + (len(self._mins) > 1))
         il = 0
-        if len(self._mins) > 1 and obj > self._mins[0]:
+        if len(self._mins) > 1:
             if l:
-                il = bisect.bisect_left(self._mins, obj) - 1
+                il = max(bisect.bisect_left(self._mins, k) - 1, 0)
             else:
-                il = bisect.bisect_right(self._mins, obj) - 1
+                il = max(bisect.bisect_right(self._mins, k) - 1, 0)
         if l:
-            ii = bisect.bisect_left(self._lists[il], obj)
+            ii = bisect.bisect_left(self._keys[il], k)
         else:
-            ii = bisect.bisect_right(self._lists[il], obj)
+            ii = bisect.bisect_right(self._keys[il], k)
         return (il, ii)
 
-    def insert(self, index, obj):
-        (il, ii) = self._index_location(index)
+    def _rank(self, k, l=1):
+        # Number of items with keys less than k, or not greater unless l
+        (il, ii) = self._key_location(k, l)
+        return self._start(il) + ii
+
+    def _slice(self, start, stop):
+        result = []
+        (il, ii) = self._index_location(start)
+        while len(result) < stop - start:
+            result.extend(self._lists[il][ii:ii + stop - start - len(result)])
+            (il, ii) = (il + 1, 0)
+        return result
+
+    def _del_range(self, r):
+        # Delete items at the positions of the range with a positive step
+        if self._cursors:
+            if r.step == 1:
+                self._moved(r.start, -len(r))
+            else:
+                for pos in reversed(r):
+                    self._moved(pos, -1)
+        if len(r) == len(self):
+            self.clear()
+            return
+        (il, ii) = self._index_location(r[0])
+        first = il
+        left = len(r)
+        while left:
+            self._own(il)
+            lst = self._lists[il]
+            n = min(len(range(ii, len(lst), r.step)), left)
+            if n:
+                cut = slice(ii, ii + (n - 1) * r.step + 1, r.step)
+                if self._where is not None:
+                    self._hash_del(il, lst[cut])
+                del lst[cut]
+                if self._key is not None:
+                    del self._keys[il][cut]
+                if self._indexed:
+                    self._shift(il, -n)
+                else:
+                    self._touch(il)
+                if self._sorted and len(lst):
+                    self._mins[il] = self._keys[il][0]
+            left -= n
+            ii += n * r.step - len(lst) - n
+            il += 1
+        survivors = 0
+        j = il - 1
+        while j >= first:
+            k = j
+            while k >= first and len(self._lists[k]) == 0:
+                k -= 1
+            if k < j:
+                self._del_list(k + 1, j - k)
+            survivors += k >= first
+            j = k - 1
+        if not self._indexed:
+            self._starts[0] = self._head
+            for j in range(max(first, 1), len(self._lists)):
+                self._starts[j] = self._starts[j-1] + len(self._lists[j-1])
+        for j in range(first + survivors - 1, first - 1, -1):
+            if j < len(self._lists):
+                self._rebalance(j)
+        if self._adaptive:
+            self._adapt()
+
+    def _splice(self, index, iter):
+        # Insert all items of iter before the index position
+        items = self._base(iter)
+        if len(items) == 0:
+            return
+        self._hash_check(items)
+        if index == len(self):
+            (il, ii) = (len(self._lists) - 1, len(self._lists[-1]))
+        else:
+            (il, ii) = self._index_location(index)
+        if self._cursors:
+            self._moved(index, len(items))
+        lst = self._lists[il]
+        self._lists[il] = lst[:ii] + items + lst[ii:]
+        if self._where is not None:
+            self._hash_add(il, items)
+        self._shift(il, len(items))
+        self._split_list(il)
+        if self._adaptive:
+            self._adapt()
+
+    def _check_unsorted(self, index):
+        if self._sorted and index not in (0, -1):
+            raise RuntimeError("No index update in the sorted list, exc 0, -1")
+
+    def _insert_at(self, il, ii, obj):
+        self._hash_check((obj,))
+        if self._cursors:
+            self._moved(self._start(il) + ii, 1)
+        self._own(il)
         self._lists[il].insert(ii, obj)
-        for j in range(il + 1, len(self._starts)):
-            self._starts[j] += 1
+        if self._where is not None:
+            self._hash_add(il, (obj,))
+        if self._key is not None:
+            self._keys[il].insert(ii, self._key(obj))
+        self._shift(il, 1)
+        self._rebalance(il)
+        if self._adaptive:
+            self._adapt()
+
+    def _pop_at(self, il, ii):
+        if self._cursors:
+            self._moved(self._start(il) + ii, -1)
+        self._own(il)
+        item = self._lists[il].pop(ii)
+        if self._where is not None:
+            self._hash_del(il, (item,))
+        if self._key is not None:
+            self._keys[il].pop(ii)
+        if self._sorted:
+            if ii == 0 and len(self._lists[il]) > 0:
+                self._mins[il] = self._keys[il][0]
+        self._shift(il, -1)
         self._rebalance(il)
+        if self._adaptive:
+            self._adapt()
+        return item
+
+    def insert(self, index, obj):
+        self._check_unsorted(index)
+        (il, ii) = self._index_location(index)
+        self._insert_at(il, ii, obj)
 
     def append(self, obj):
+        k = self._key_of(obj)
+        self._hash_check((obj,))
         if len(self._mins) == 0:
-            self._mins.append(obj)
+            self._mins.append(k)
         if len(self._lists[-1]) >= self._load:
             self._insert_list(len(self._lists))
+        self._own(len(self._lists) - 1)
         self._lists[-1].append(obj)
+        if self._where is not None:
+            self._hash_add(len(self._lists) - 1, (obj,))
+        if self._key is not None:
+            self._keys[-1].append(k)
+        if self._indexed or self._aggs:
+            self._shift(len(self._lists) - 1, 1)
+        if self._adaptive:
+            self._adapt()
 
     def extend(self, iter):
-        for n in iter:
-            self.append(n)
+        items = self._base(iter)
+        if len(items) == 0:
+            return
+        self._hash_check(items)
+        keys = items
+        if self._key is not None:
+            keys = self._keybase(map(self._key, items))
+        if len(self._mins) == 0:
+            self._mins.append(keys[0])
+        pos = 0
+        while pos < len(items):
+            if len(self._lists[-1]) >= self._load:
+                self._insert_list(len(self._lists))
+            chunk = items[pos:pos + self._load - len(self._lists[-1])]
+            self._own(len(self._lists) - 1)
+            self._lists[-1].extend(chunk)
+            if self._where is not None:
+                self._hash_add(len(self._lists) - 1, chunk)
+            if self._key is not None:
+                self._keys[-1].extend(keys[pos:pos + len(chunk)])
+            self._shift(len(self._lists) - 1, len(chunk))
+            pos += len(chunk)
+        if self._adaptive:
+            self._adapt()
 
     def pop(self, index=None):
         if index is None:
             index = -1
         (il, ii) = self._index_location(index)
-        item = self._lists[il].pop(ii)
-        if self._sorted:
-            if ii == 0 and len(self._lists[il]) > 0:
-                self._mins[il] = self._lists[il][0]
+        return self._pop_at(il, ii)
+
+    def popleft(self):
+        """ Remove and return the first item """
+        return self.pop(0)
+
+    def appendleft(self, obj):
+        """ Insert obj before the first item """
+        if len(self._lists[0]) == 0:
+            self.append(obj)
         else:
-            for j in range(il + 1, len(self._starts)):
-                self._starts[j] -= 1
-        self._rebalance(il)
-        return item
+            self.insert(0, obj)
 
     def clear(self):
+        if self._cursors:
+            self._moved(0, -len(self))
         self._lists = []
+        self._keys = self._lists if self._key is None else []
         self._starts = Arrl()
-        self._mins = self._base()
+        self._head = 0
+        self._mins = self._keybase()
+        self._fw = None
+        if self._where is not None:
+            (self._where, self._tokens) = ({}, [])
+        self._avals = []
+        self._adirty = set()
+        self._cow = set()
         self._insert_list(0)
 
+    def snapshot(self):
+        """ Copy sharing the sublists until either side updates them """
+        return self._share(type(self))
+
+    def stats(self, reset=0):
+        """ Statistics: counters of the structural events, [calls, seconds]
+        per public operation and the sublist sizes by power of 2 buckets """
+        sizes = collections.Counter(
+            1 << max(len(lst) - 1, 0).bit_length() for lst in self._lists)
+        result = {
+            "load": self._load, "sublists": len(self._lists),
+            "sizes": dict(sorted(sizes.items())),
+            "counters": dict(self._stats or {}),
+            "ops": {name: tuple(t) for (name, t) in self._times.items()}}
+        if reset and self._stats is not None:
+            self._stats.clear()
+            self._times.clear()
+        return result
+
+    def _share(self, cls):
+        result = object.__new__(cls)
+        result.__dict__.update(self.__dict__)
+        result._lists = self._lists[:]
+        if isinstance(result._lists, _Lazylists):
+            result._lists._owner = weakref.ref(result)
+        result._keys = result._lists if self._key is None else self._keys[:]
+        result._mins = self._mins[:]
+        result._starts = self._starts[:]
+        result._fw = None
+        result._aggs = self._aggs[:]
+        result._anames = dict(self._anames)
+        result._avals = self._avals[:]
+        result._atrees = None
+        result._adirty = set(self._adirty)
+        result._mix = self._mix[:]
+        if self._where is not None:
+            result._tokens = self._tokens[:]
+            result._where = {obj: dict(tokens)
+                             for (obj, tokens) in self._where.items()}
+        if self._stats is not None:
+            (result._stats, result._times) = (collections.Counter(), {})
+        (result._cursors, result._cursor) = ({}, None)
+        self._cow.update(map(id, self._lists))
+        self._cow.update(map(id, self._keys))
+        result._cow = set(self._cow)
+        return result
+
     def as_list(self):
-        return list(sum(self._lists, self._base()))
+        if self._adaptive:
+            self._mix[2] += 1
+        return list(itertools.chain.from_iterable(self._lists))
+
+    def as_buffer(self):
+        """ Memoryview of a contiguous copy of the array sublist items """
+        views = [_buffer(lst) for lst in self._lists]
+        if issubclass(self._base, Nparr):
+            return memoryview(numpy.concatenate(views))
+        result = self._base()
+        for view in views:
+            result.frombytes(view.cast("B"))
+        return _buffer(result)
+
+    def buffers(self, start=None, stop=None):
+        """ Memoryviews of the array sublists, release them before updates """
+        (start, stop, _) = slice(start, stop).indices(len(self))
+        if start >= stop:
+            return
+        (il, ii) = self._index_location(start)
+        left = stop - start
+        while left:
+            view = _buffer(self._lists[il])
+            if ii or len(view) - ii > left:
+                view = view[ii:ii + left]
+            left -= len(view)
+            yield view
+            (il, ii) = (il + 1, 0)
+
+    def _true_starts(self):
+        return [start - self._head for start in self._starts]
+
+    def _write(self, f, objects="json"):
+        # JSON header followed by raw 8 byte aligned typed sections. Items
+        # of other than array sublists go to one section as JSON values,
+        # or as a pickle when the state is pickled anyway
+        if self._key is not None:
+            raise RuntimeError("Lists with a key function can't be dumped")
+        if _BASES.get(self._base.__name__) is not self._base:
+            raise RuntimeError("Lists with the {} base can't be dumped"
+                               .format(self._base.__name__))
+        aggs = sorted((i, name) for (name, i) in self._anames.items())
+        for (i, name) in aggs:
+            if self._aggs[i] != _AGGREGATES.get(name):
+                raise RuntimeError(
+                    "Custom aggregate {} can't be dumped, add it again "
+                    "after the load".format(name))
+        header = {
+            "version": _LAYOUT, "load": self._load, "sorted": self._sorted,
+            "base": self._base.__name__, "indexed": self._indexed,
+            "adaptive": self._adaptive, "hashed": self._where is not None,
+            "aggs": [name for (i, name) in aggs]}
+        header.update(self._layout_state())
+        # Starts from the sublist lengths, indexed lists don't keep them
+        starts = memoryview(Arrq(itertools.accumulate(
+            itertools.chain([0], map(len, self._lists[:-1])))))
+        try:
+            views = [_buffer(lst) for lst in self._lists]
+            sections = [starts, _buffer(self._mins)] + views
+            header["format"] = views[0].format
+        except TypeError:
+            if objects == "json":
+                for lst in self._lists:
+                    if not all(map(_json_safe, lst)):
+                        raise RuntimeError(
+                            "Items other than JSON strings, numbers, lists "
+                            "and objects can't be dumped")
+                data = json.dumps([self._lists, self._mins]).encode()
+            else:
+                data = pickle.dumps(
+                    (self._lists, self._mins), pickle.HIGHEST_PROTOCOL)
+            sections = [starts, memoryview(data)]
+            (header["format"], header["objects"]) = (None, objects)
+        pos = 0
+        header["sections"] = []
+        for view in sections:
+            header["sections"].append([pos, len(view)])
+            pos += view.nbytes + (-view.nbytes % 8)
+        data = json.dumps(header).encode()
+        f.write(_MAGIC + struct.pack("<Q", len(data)) + data)
+        f.write(bytes(-len(data) % 8))
+        for view in sections:
+            view = view.cast("B")
+            f.write(view)
+            f.write(bytes(-len(view) % 8))
+
+    @staticmethod
+    def _header(buf, size):
+        # Header of the _write layout at the start of buf, checked against
+        # the layout size before any section is read
+        if len(buf) < 16 or bytes(buf[:8]) != _MAGIC:
+            raise ValueError("Not a dumped Fastlist")
+        n = struct.unpack_from("<Q", buf, 8)[0]
+        try:
+            header = json.loads(bytes(buf[16:16 + n]).decode())
+            base = _BASES[header["base"]]
+            fmt = header["format"]
+            sections = header["sections"]
+            if header["version"] != _LAYOUT:
+                raise ValueError("Unknown layout version")
+            if fmt is not None and fmt != _buffer(base()).format:
+                raise ValueError("Format doesn't match the base")
+            if len(sections) < 2 or (fmt is None and len(sections) != 2):
+                raise ValueError("Wrong number of sections")
+            data = 16 + n + (-n % 8)
+            sizes = [8] + [1 if fmt is None else struct.calcsize(fmt)] * (
+                len(sections) - 1)
+            for ((pos, count), itemsize) in zip(sections, sizes):
+                if not (isinstance(pos, int) and isinstance(count, int) and
+                        0 <= pos and pos % 8 == 0 and 0 <= count and
+                        data + pos + count * itemsize <= size):
+                    raise ValueError("Section out of the layout")
+            if not isinstance(header["load"], int) or header["load"] < 1:
+                raise ValueError("Wrong load")
+            if not set(header["aggs"]) <= set(_AGGREGATES):
+                raise ValueError("Unknown aggregate")
+            adaptive = header["adaptive"]
+            header["adaptive"] = tuple(adaptive) if adaptive else 0
+        except (KeyError, TypeError, ValueError, UnicodeDecodeError) as e:
+            raise ValueError("Not a valid dumped Fastlist: {}".format(e))
+        (header["base"], header["data"]) = (base, data)
+        return header
+
+    def _read(self, buf, lazy=0, trusted=0):
+        # Rebuild the list from the _write layout in buf. Pickled items
+        # are read only from trusted buffers
+        buf = memoryview(buf).cast("B")
+        header = self._header(buf, len(buf))
+        sections = header["sections"]
+
+        def section(k, fmt):
+            (pos, n) = sections[k]
+            pos += header["data"]
+            return buf[pos:pos + n * struct.calcsize(fmt)].cast(fmt)
+
+        Fastlist.__init__(
+            self, load=header["load"], sorted=header["sorted"],
+            base=header["base"], indexed=header["indexed"],
+            adaptive=header["adaptive"], hashed=header["hashed"])
+        for name in header["aggs"]:
+            self.add_aggregate(name)
+        fmt = header["format"]
+        self._starts = Arrl(section(0, "q"))
+        if fmt is None:
+            data = bytes(section(1, "B"))
+            if header.get("objects") == "json":
+                (lists, mins) = json.loads(data.decode())
+            elif header.get("objects") == "pickle" and trusted:
+                (lists, mins) = pickle.loads(data)
+            else:
+                raise ValueError("Pickled items of an untrusted Fastlist")
+            self._lists[:] = [self._base(lst) for lst in lists]
+            self._mins = self._keybase(mins)
+        else:
+            self._mins = _from_buffer(self._keybase, section(1, fmt))
+            views = [section(k, fmt) for k in range(2, len(sections))]
+            if lazy:
+                self._lists = _Lazylists(
+                    map(_Mapped, views), self._base, self)
+            else:
+                self._lists = [_from_buffer(self._base, v) for v in views]
+            self._keys = self._lists
+        if not self._sorted and len(self._starts) != len(self._lists):
+            raise ValueError("Not a valid dumped Fastlist")
+        self._avals = [None] * len(self._lists)
+        if self._where is not None:
+            self._rehash()
+        return header
+
+    def _layout_state(self):
+        # Settings of a subclass stored in the dump header
+        return {}
+
+    def dump(self, path):
+        """ Store the list in a file: a JSON header, then array sublists as
+        raw typed data and other sublists as JSON values """
+        with open(path, "wb") as f:
+            self._write(f)
+
+    @classmethod
+    def load(cls, path, lazy=1):
+        """ List stored by dump, lazy loads memory map the array sublists
+        once the header is checked """
+        result = object.__new__(cls)
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            head = f.read(16)
+            if len(head) == 16 and head[:8] == _MAGIC:
+                head += f.read(struct.unpack_from("<Q", head, 8)[0])
+            cls._header(head, size)
+            if lazy:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                f.seek(0)
+                buf = f.read()
+        result._read(buf, lazy)
+        return result
+
+    @classmethod
+    def _empty_sorted(cls, **kwargs):
+        return cls(sorted=1, **kwargs)
+
+    @classmethod
+    def from_unsorted(cls, iterable, workers=None, min_items=100000,
+                      **kwargs):
+        """ Sorted list of the items. Lists shorter than min_items, or with
+        a key that can't be pickled, are sorted serially. Otherwise chunks
+        are sorted by a pool of worker processes, array chunks in place in
+        shared memory, then the concatenated runs are merged by timsort and
+        laid out into even sublists """
+        result = cls._empty_sorted(**kwargs)
+        workers = workers or os.cpu_count() or 1
+        (base, key) = (result._base, result._key)
+        shared = key is None and issubclass(base, (array.array, Nparr))
+        items = base(iterable) if shared else list(iterable)
+        n = len(items)
+        if (workers < 2 or n < max(min_items, workers * 2) or
+                not _picklable(key)):
+            result._lay_out(base(sorted(items, key=key)))
+            return result
+        cuts = [n * k // workers for k in range(workers + 1)]
+        pool = concurrent.futures.ProcessPoolExecutor(workers)
+        if not shared:
+            with pool:
+                runs = list(pool.map(_sort_chunk, [
+                    (items[cuts[k]:cuts[k+1]], key) for k in range(workers)]))
+            del items
+            # Timsort detects the sorted runs, faster than a heap merge
+            result._lay_out(base(sorted(
+                itertools.chain.from_iterable(runs), key=key)))
+            return result
+        view = _buffer(items)
+        (fmt, size) = (view.format, view.nbytes)
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        try:
+            shm.buf[:size] = view.cast("B")
+            del view, items
+            with pool:
+                list(pool.map(_sort_shared, [
+                    (shm.name, fmt, cuts[k], cuts[k+1])
+                    for k in range(workers)]))
+            with shm.buf.cast(fmt) as view, view[:n] as runs:
+                if numpy is not None:
+                    # Stable NumPy sort is a timsort merging the sorted runs
+                    merged = numpy.asarray(runs).copy()
+                    merged.sort(kind="stable")
+                    merged = _from_buffer(base, memoryview(merged))
+                else:
+                    merged = base(sorted(runs))
+        finally:
+            shm.close()
+            shm.unlink()
+        result._lay_out(merged)
+        return result
+
+    def __getstate__(self):
+        f = io.BytesIO()
+        try:
+            self._write(f, objects="pickle")
+        except RuntimeError:
+            # Keys, custom aggregates and other bases keep the attributes
+            return self._attrs()
+        return f.getvalue()
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            self._from_attrs(state)
+        else:
+            self._read(state, trusted=1)
+
+    def _attrs(self):
+        # Attributes to pickle, without the cursors, statistics and the
+        # sublists shared with snapshots
+        state = dict(self.__dict__)
+        lists = [self._lists[il] for il in range(len(self._lists))]
+        state["_lists"] = lists
+        if self._key is None:
+            state["_keys"] = lists
+        (state["_cursors"], state["_cursor"]) = ({}, None)
+        state["_cow"] = set()
+        (state["_stats"], state["_hook"], state["_times"]) = (None, None, {})
+        state["_atrees"] = None
+        state["_tokgen"] = next(self._tokgen)
+        return state
+
+    def _from_attrs(self, state):
+        state["_tokgen"] = itertools.count(state["_tokgen"])
+        self.__dict__.update(state)
 
     def insort(self, obj, l=0):
+        k = self._key_of(obj)
         if len(self._mins) == 0:
-            self._mins.append(obj)
-        (il, ii) = self._obj_location(obj, l)
+            self._mins.append(k)
+        (il, ii) = self._key_location(k, l)
+        if self._cursors:
+            self._moved(self._start(il) + ii, 1)
+        self._own(il)
         self._lists[il].insert(ii, obj)
+        if self._key is not None:
+            self._keys[il].insert(ii, k)
         if ii == 0:
-            self._mins[il] = obj
+            self._mins[il] = k
+        self._shift(il, 1)
         self._rebalance(il)
+        if self._adaptive:
+            self._adapt()
 
     def insort_left(self, obj):
         self.insort(obj, l=1)
 
+    def insort_many(self, iter):
+        values = self._base(sorted(iter, key=self._key))
+        if len(values) == 0:
+            return
+        keys = values
+        if self._key is not None:
+            keys = self._keybase(map(self._key, values))
+        if len(self._mins) == 0:
+            self._mins.append(keys[0])
+        touched = []
+        pos = 0
+        while pos < len(values):
+            il = max(bisect.bisect_right(self._mins, keys[pos]) - 1, 0)
+            end = len(values)
+            if il + 1 < len(self._mins):
+                end = bisect.bisect_left(keys, self._mins[il+1], pos)
+            group = values[pos:end]
+            if self._cursors:
+                self._merged(il, keys[pos:end])
+            if self._key is None:
+                self._lists[il] = self._base(sorted(self._lists[il] + group))
+            else:
+                objs = self._lists[il] + group
+                ks = self._keys[il] + keys[pos:end]
+                order = sorted(range(len(ks)), key=ks.__getitem__)
+                self._lists[il] = self._base([objs[i] for i in order])
+                self._keys[il] = self._keybase([ks[i] for i in order])
+            self._mins[il] = self._keys[il][0]
+            self._shift(il, len(group))
+            touched.append(il)
+            pos = end
+        for il in reversed(touched):
+            self._split_list(il)
+        if self._adaptive:
+            self._adapt()
+
+    def index(self, obj):
+        if not self._sorted:
+            return self._index_unsorted(obj)
+        loc = self._locate(obj)
+        if loc is None:
+            raise ValueError("{} is not in list".format(obj))
+        return self._start(loc[0]) + loc[1]
+
+    def _index_unsorted(self, obj):
+        # First sublist from the hash index tokens, or a scan of sublists
+        if self._where is not None:
+            tokens = self._where.get(obj)
+            if tokens:
+                il = min(map(self._token_pos().__getitem__, tokens))
+                return self._start(il) + self._lists[il].index(obj)
+        else:
+            for il in range(len(self._lists)):
+                if obj in self._lists[il]:
+                    return self._start(il) + self._lists[il].index(obj)
+        raise ValueError("{} is not in list".format(obj))
+
+    def _equal_keys(self, obj):
+        # Locations of the items with the key of obj, in order
+        k = self._key_of(obj)
+        (il, ii) = self._key_location(k, l=1)
+        while il < len(self._lists):
+            keys = self._keys[il]
+            while ii < len(keys):
+                if keys[ii] != k:
+                    return
+                yield (il, ii)
+                ii += 1
+            (il, ii) = (il + 1, 0)
+
+    def _locate(self, obj):
+        # Location of the first item equal to obj, None if there is no such
+        if self._sorted:
+            for (il, ii) in self._equal_keys(obj):
+                if self._lists[il][ii] == obj:
+                    return (il, ii)
+                if self._key is None:
+                    break
+            return None
+        try:
+            return self._index_location(self._index_unsorted(obj))
+        except ValueError:
+            return None
+
+    def count(self, obj):
+        """ Number of items equal to obj """
+        if self._where is not None:
+            return sum(self._where.get(obj, {}).values())
+        if self._sorted and self._key is None:
+            (il, ii) = self._key_location(obj, l=1)
+            (jl, ji) = self._key_location(obj)
+            return self._start(jl) + ji - self._start(il) - ii
+        if self._sorted:
+            return sum(self._lists[il][ii] == obj
+                       for (il, ii) in self._equal_keys(obj))
+        lists = self._lists
+        return sum(lists[il].count(obj) for il in range(len(lists)))
+
+    def remove(self, obj):
+        """ Remove the first item equal to obj, ValueError if none """
+        if not self.discard(obj):
+            raise ValueError("{} is not in list".format(obj))
+
+    def discard(self, obj):
+        """ Remove the first item equal to obj if any, True if removed """
+        if len(self._lists[0]) == 0:
+            return False
+        loc = self._locate(obj)
+        if loc is None:
+            return False
+        self._pop_at(*loc)
+        return True
+
+    def remove_range(self, lo=None, hi=None, inclusive=(True, False)):
+        """ Remove the items with keys between lo and hi, whole sublists
+        in the range are dropped at once """
+        if len(self._lists[0]) == 0:
+            return
+        start = 0
+        if lo is not None:
+            start = self._rank(lo, l=inclusive[0])
+        stop = len(self)
+        if hi is not None:
+            stop = self._rank(hi, l=not inclusive[1])
+        if stop > start:
+            self._del_range(range(start, stop))
+
+    def add_aggregate(self, name, op=None, fold=None):
+        """ Keep a sum, min, max, count or custom op aggregate per sublist """
+        if op is None:
+            (fold, op) = _AGGREGATES[name]
+        if fold is None:
+            fold = functools.partial(functools.reduce, op)
+        self._anames[name] = len(self._aggs)
+        self._aggs.append((fold, op))
+        self._avals = [None] * len(self._lists)
+        self._adirty.clear()
+        self._atrees = None
+
+    def _agg_fold(self, il):
+        lst = self._lists[il]
+        if len(lst) == 0:
+            return tuple(_EMPTY for agg in self._aggs)
+        return tuple(fold(lst) for (fold, op) in self._aggs)
+
+    def _agg_update(self):
+        # Refresh the aggregates of changed sublists and the trees above
+        if self._atrees is None:
+            self._agg_flush()
+            for il in range(len(self._avals)):
+                if self._avals[il] is None:
+                    self._avals[il] = self._agg_fold(il)
+            self._atrees = [
+                Segtree([v[k] for v in self._avals], op)
+                for (k, (fold, op)) in enumerate(self._aggs)]
+            return
+        for il in self._adirty:
+            self._avals[il] = self._agg_fold(il)
+            for (k, tree) in enumerate(self._atrees):
+                tree.set(il, self._avals[il][k])
+        self._adirty.clear()
+
+    def aggregate(self, name, i=0, j=None, default=None):
+        """ Aggregate of the items in the [i, j) index range """
+        return self._agg_result(self._agg_parts(name, i, j), default)
+
+    def _agg_parts(self, name, i, j):
+        # Fold and tree of the aggregate, copies of the partial sublists at
+        # the ends of the [i, j) index range and the aggregate in between.
+        # None for an empty range
+        (i, j, step) = slice(i, j).indices(len(self))
+        if i >= j:
+            return None
+        self._agg_update()
+        k = self._anames[name]
+        fold = self._aggs[k][0]
+        (il, ii) = self._index_location(i)
+        if j == len(self):
+            (jl, ji) = (len(self._lists) - 1, len(self._lists[-1]))
+        else:
+            (jl, ji) = self._index_location(j)
+        if il == jl:
+            return (fold, None, [self._lists[il][ii:ji]], _EMPTY)
+        tree = self._atrees[k]
+        ends = [self._lists[il][ii:]] + ([self._lists[jl][:ji]] if ji else [])
+        return (fold, tree, ends, tree.query(il + 1, jl))
+
+    def _agg_result(self, parts, default):
+        if parts is None:
+            return default
+        (fold, tree, ends, middle) = parts
+        if tree is None:
+            return fold(ends[0])
+        result = tree.combine(fold(ends[0]), middle)
+        if len(ends) > 1:
+            result = tree.combine(result, fold(ends[1]))
+        return result
+
+    def aggregate_range(self, name, lo, hi, default=None):
+        """ Aggregate of the items with keys in the [lo, hi) range """
+        return self.aggregate(name, self._rank(lo), self._rank(hi), default)
+
+    def _iter_at(self, il, ii, jl, ji, reverse=0):
+        # Generate the items from (il, ii) up to (jl, ji) sublist by sublist
+        if self._adaptive:
+            self._mix[2] += 1
+        if (il, ii) >= (jl, ji):
+            return
+        sublists = range(il, jl + 1)
+        for j in reversed(sublists) if reverse else sublists:
+            lst = self._lists[j]
+            part = lst[ii if j == il else 0:ji if j == jl else len(lst)]
+            yield from part[::-1] if reverse else part
+
+    def irange(self, lo=None, hi=None, inclusive=(True, False), reverse=0):
+        """ Lazy iterator over the items with keys between lo and hi """
+        (il, ii) = (0, 0)
+        if lo is not None:
+            (il, ii) = self._key_location(lo, l=inclusive[0])
+        (jl, ji) = (len(self._lists) - 1, len(self._lists[-1]))
+        if hi is not None:
+            (jl, ji) = self._key_location(hi, l=not inclusive[1])
+        return self._iter_at(il, ii, jl, ji, reverse)
+
+    def islice(self, start=None, stop=None, reverse=0):
+        """ Lazy iterator over the items in the [start, stop) index range """
+        (start, stop, step) = slice(start, stop).indices(len(self))
+        if start >= stop:
+            return iter(())
+        (il, ii) = self._index_location(start)
+        if stop == len(self):
+            (jl, ji) = (len(self._lists) - 1, len(self._lists[-1]))
+        else:
+            (jl, ji) = self._index_location(stop)
+        return self._iter_at(il, ii, jl, ji, reverse)
+
+    def _seek(self, il, ii, k, right=0):
+        # First location from (il, ii) with a key not less than k, or
+        # greater if right, galloping over the sublist minimums first
+        jl = max(_gallop(self._mins, k, il + 1, right) - 1, il)
+        keys = self._keys[jl]
+        ji = _gallop(keys, k, ii if jl == il else 0, right)
+        if ji == len(keys) and jl + 1 < len(self._keys):
+            return (jl + 1, 0)
+        return (jl, ji)
+
+    def _advance(self, il, ii, n):
+        # Location n items after (il, ii)
+        ii += n
+        while ii >= len(self._keys[il]) and il + 1 < len(self._keys):
+            ii -= len(self._keys[il])
+            il += 1
+        return (il, ii)
+
+    def _combine_with(self, other, count):
+        # Walk both sorted lists a window at a time: the rest of a sublist
+        # up to the end of its last run and the items of other in its key
+        # range. Items between windows are copied a sublist slice at a
+        # time. Windows of like sizes are combined in one flat pass, in
+        # lopsided ones the runs are galloped over by the sublist minimums
+        if not self._sorted or not other._sorted:
+            raise RuntimeError("No set operations on an unsorted list")
+        result = self._empty_like()
+        (load, keyed) = (self._load, self._key is not None)
+        (lists, keys) = ([], [])
+        (keep_a, keep_b) = (count(1, 0) > 0, count(0, 1) > 0)
+
+        def add(items, ks):
+            # Fill the last sublist of the result up to the load, cut the
+            # rest into sublists of the load up to twice the load items
+            pos = 0
+            if lists and len(lists[-1]) < load:
+                pos = load - len(lists[-1])
+                lists[-1] += items[:pos]
+                if keyed:
+                    keys[-1] += ks[:pos]
+            while pos < len(items):
+                end = pos + load
+                if len(items) - pos < load * 2:
+                    end = len(items)
+                lists.append(items if end - pos == len(items) else
+                             items[pos:end])
+                if keyed:
+                    keys.append(ks if end - pos == len(ks) else ks[pos:end])
+                pos = end
+
+        def put(fl, il, ii, jl, ji):
+            # Copy the items of fl between the two locations
+            for t in range(il, jl + 1):
+                (a, b) = (ii if t == il else 0,
+                          ji if t == jl else len(fl._lists[t]))
+                if a < b:
+                    items = fl._lists[t][a:b]
+                    ks = fl._keys[t][a:b] if keyed else items
+                    if fl._base is not self._base:
+                        items = self._base(items)
+                    if keyed and fl._keybase is not self._keybase:
+                        ks = self._keybase(ks)
+                    add(items, ks)
+
+        def flat(fl, il, ii, jl, ji):
+            # Items and keys of fl between the two locations as lists
+            parts = [(fl._lists[t], fl._keys[t], ii if t == il else 0,
+                      ji if t == jl else len(fl._lists[t]))
+                     for t in range(il, jl + 1)]
+            items = list(itertools.chain.from_iterable(
+                v[a:b] for (v, k, a, b) in parts))
+            if not keyed:
+                return (items, items)
+            return (items, list(itertools.chain.from_iterable(
+                k[a:b] for (v, k, a, b) in parts)))
+
+        def walk(il, ii, al, ai, jl, ji, bl, bi):
+            # Runs of the two windows, galloping by the sublist minimums
+            while (il, ii) < (al, ai) and (jl, ji) < (bl, bi):
+                (x, y) = (self._keys[il][ii], other._keys[jl][ji])
+                if x < y:
+                    (el, ei) = self._seek(il, ii, y)
+                    if keep_a:
+                        put(self, il, ii, el, ei)
+                    (il, ii) = (el, ei)
+                elif y < x:
+                    (el, ei) = other._seek(jl, ji, x)
+                    if keep_b:
+                        put(other, jl, ji, el, ei)
+                    (jl, ji) = (el, ei)
+                else:
+                    (el, ei) = self._seek(il, ii, x, right=1)
+                    (fl, fi) = other._seek(jl, ji, y, right=1)
+                    na = self._start(el) + ei - self._start(il) - ii
+                    nb = other._start(fl) + fi - other._start(jl) - ji
+                    n = count(na, nb)
+                    put(self, il, ii, *self._advance(il, ii, min(n, na)))
+                    if n > na:
+                        put(other, jl, ji, *other._advance(jl, ji, n - na))
+                    (il, ii, jl, ji) = (el, ei, fl, fi)
+            if keep_a:
+                put(self, il, ii, al, ai)
+            if keep_b:
+                put(other, jl, ji, bl, bi)
+
+        (ka, kb) = (self._keys, other._keys)
+        (il, ii, jl, ji) = (0, 0, 0, 0)
+        while ii < len(ka[il]) and ji < len(kb[jl]):
+            (lo, hi) = (ka[il][ii], ka[il][-1])
+            (al, ai) = self._seek(il, ii, hi, right=1)
+            (bl, bi) = other._seek(jl, ji, lo)
+            if keep_b:
+                put(other, jl, ji, bl, bi)
+            (jl, ji) = (bl, bi)
+            (bl, bi) = other._seek(jl, ji, hi, right=1)
+            na = self._start(al) + ai - self._start(il) - ii
+            nb = other._start(bl) + bi - other._start(jl) - ji
+            if nb == 0:
+                if keep_a:
+                    put(self, il, ii, al, ai)
+            elif max(na, nb) > min(na, nb) * 8:
+                walk(il, ii, al, ai, jl, ji, bl, bi)
+            else:
+                (va, wa) = flat(self, il, ii, al, ai)
+                (vb, wb) = flat(other, jl, ji, bl, bi)
+                (items, ks) = _combine_runs(wa, va, wb, vb, count, keyed)
+                add(self._base(items),
+                    self._keybase(ks) if keyed else None)
+            (il, ii, jl, ji) = (al, ai, bl, bi)
+        if keep_a:
+            put(self, il, ii, len(ka) - 1, len(ka[-1]))
+        if keep_b:
+            put(other, jl, ji, len(kb) - 1, len(kb[-1]))
+        if len(lists) > 1 and len(lists[-1]) < load * 0.2:
+            # Short last sublist joins the one before, halved if too big
+            for sub in [lists] + ([keys] if keyed else []):
+                last = sub.pop()
+                sub[-1] += last
+                if len(sub[-1]) >= load * 2:
+                    half = len(sub[-1]) // 2
+                    sub[-1:] = [sub[-1][:half], sub[-1][half:]]
+        result._set_lists(lists, keys if keyed else None)
+        return result
+
+    def merge(self, other):
+        """ Sorted list of the items of both lists """
+        return self._combine_with(other, operator.add)
+
+    def union(self, other):
+        """ Sorted list of the items in any list, by max count """
+        return self._combine_with(other, max)
+
+    def intersection(self, other):
+        """ Sorted list of the items in both lists, by min count """
+        return self._combine_with(other, min)
+
+    def difference(self, other):
+        """ Sorted list of the items not in the other list """
+        return self._combine_with(other, lambda na, nb: max(na - nb, 0))
+
+    def symmetric_difference(self, other):
+        """ Sorted list of the items in just one of the lists """
+        return self._combine_with(other, lambda na, nb: abs(na - nb))
+
+    def _sweep(self, values, right):
+        # Locations of many keys, found in the order of the sorted keys
+        bis = bisect.bisect_right if right else bisect.bisect_left
+        (mins, keys, last) = (self._mins, self._keys, len(self._lists) - 1)
+        result = [None] * len(values)
+        (il, ii) = (0, 0)
+        for i in sorted(range(len(values)), key=values.__getitem__):
+            k = values[i]
+            if il != last and (mins[il+1] <= k if right else mins[il+1] < k):
+                (il, ii) = (bis(mins, k, il + 1) - 1, 0)
+            ii = bis(keys[il], k, ii)
+            result[i] = (il, ii)
+        return result
+
+    def bisect_many(self, values, right=0):
+        """ Bisect positions of many keys in one sorted sweep """
+        if not self._sorted:
+            raise RuntimeError("No by-value access to an unsorted list")
+        values = list(values)
+        if (numpy is not None and
+                issubclass(self._keybase, (Nparr, array.array))):
+            return self._bisect_numpy(values, right).tolist()
+        starts = [0] + list(itertools.accumulate(map(len, self._lists)))
+        return [starts[il] + ii for (il, ii) in self._sweep(values, right)]
+
+    def _bisect_numpy(self, values, right):
+        side = "right" if right else "left"
+        probes = numpy.asarray(values)
+        lens = numpy.array([len(l) for l in self._lists])
+        starts = numpy.concatenate(([0], numpy.cumsum(lens)[:-1]))
+        il = numpy.searchsorted(_np_view(self._mins), probes, side) - 1
+        il = numpy.maximum(il, 0)
+        order = numpy.argsort(il, kind="stable")
+        bounds = numpy.searchsorted(il[order], numpy.arange(len(lens) + 1))
+        result = numpy.empty(len(probes), "int64")
+        for j in numpy.unique(il).tolist():
+            at = order[bounds[j]:bounds[j+1]]
+            keys = _np_view(self._keys[j])
+            result[at] = starts[j] + numpy.searchsorted(keys, probes[at], side)
+        return result
+
+    def count_many(self, values):
+        """ Numbers of items with each of many keys """
+        values = list(values)
+        return [b - a for (a, b) in zip(self.bisect_many(values),
+                                        self.bisect_many(values, right=1))]
+
+    def contains_many(self, values):
+        """ Presence of items with each of many keys """
+        values = list(values)
+        if (numpy is not None and
+                issubclass(self._keybase, (Nparr, array.array))):
+            return [n > 0 for n in self.count_many(values)]
+        if not self._sorted:
+            raise RuntimeError("No by-value access to an unsorted list")
+        result = []
+        for (k, (il, ii)) in zip(values, self._sweep(values, 0)):
+            if ii == len(self._keys[il]) and il != len(self._lists) - 1:
+                (il, ii) = (il + 1, 0)
+            keys = self._keys[il]
+            result.append(ii != len(keys) and keys[ii] == k)
+        return result
+
     def add(self, obj):
         if self._sorted:
             self.insort(obj)
@@ -194,12 +2217,48 @@ class Fastlist(object):
 
     def __setitem__(self, index, obj):
         if isinstance(index, int):
+            self._check_unsorted(index)
             (il, ii) = self._index_location(index)
+            self._hash_check((obj,))
+            self._own(il)
+            if self._where is not None:
+                self._hash_del(il, (self._lists[il][ii],))
+                self._hash_add(il, (obj,))
             self._lists[il][ii] = obj
+            if self._key is not None:
+                self._keys[il][ii] = self._key(obj)
+            self._touch(il)
+            if self._adaptive:
+                self._adapt()
         elif isinstance(index, slice):
-            raise RuntimeError("Slice assignment is not supported")
+            if self._sorted:
+                raise RuntimeError("No slice assignment to the sorted list")
+            r = range(*index.indices(len(self)))
+            items = list(obj)
+            self._hash_check(items)
+            if r.step == 1:
+                if len(r):
+                    self._del_range(r)
+                self._splice(r.start, items)
+                return
+            if len(items) != len(r):
+                raise ValueError(
+                    "attempt to assign sequence of size {} to extended slice "
+                    "of size {}".format(len(items), len(r)))
+            for (i, item) in zip(r, items):
+                (il, ii) = self._index_location(i)
+                self._own(il)
+                if self._where is not None:
+                    self._hash_del(il, (self._lists[il][ii],))
+                    self._hash_add(il, (item,))
+                self._lists[il][ii] = item
+                self._touch(il)
+            if self._adaptive:
+                self._adapt()
 
     def __getitem__(self, index):
+        if self._adaptive:
+            self._mix[0] += 1
         if isinstance(index, int):
             (il, ii) = self._index_location(index)
             return self._lists[il][ii]
@@ -207,103 +2266,1311 @@ class Fastlist(object):
             rg = index.indices(len(self))
             if rg[0] == 0 and rg[1] == len(self) and rg[2] == 1:
                 return self.as_list()
-            return [self.__getitem__(index) for index in range(*rg)]
+            r = range(*rg)
+            if len(r) == 0:
+                return []
+            lo = min(r[0], r[-1])
+            return self._slice(lo, max(r[0], r[-1]) + 1)[r[0] - lo::rg[2]]
 
     def __iadd__(self, obj):
         if self._sorted:
-            [self.insort(n) for n in obj]
+            self.insort_many(obj)
         else:
-            [self.append(n) for n in obj]
+            self.extend(obj)
         return self
 
     def __delitem__(self, index):
         if isinstance(index, int):
             self.pop(index)
         elif isinstance(index, slice):
-            rg = index.indices(len(self))
-            [self.__delitem__(rg[0]) for i in range(*rg)]
+            r = range(*index.indices(len(self)))
+            if len(r):
+                self._del_range(r if r.step > 0 else r[::-1])
 
     def __len__(self):
-        if self._sorted:
-            return sum([len(l) for l in self._lists])
-        return self._starts[-1] + len(self._lists[-1])
+        if self._indexed:
+            return self._fenwick().total
+        return self._starts[-1] - self._head + len(self._lists[-1])
 
     def __contains__(self, obj):
         if self._sorted:
-            it = self.lower_bound(obj)
-            return not it.iter_end() and obj == it.iter_getitem()
+            return self._locate(obj) is not None
+        elif self._where is not None:
+            return obj in self._where
         else:
-            for n in self:
-                if obj == n:
-                    return True
-            return False
+            lists = self._lists
+            return any(obj in lists[il] for il in range(len(lists)))
 
     def __bool__(self):
         return len(self._lists[0]) != 0
 
     def __iter__(self):
-        if not self._irev:
-            self._il = self._ii = 0
-        else:
-            self._il = len(self._lists) - 1
-            self._ii = len(self._lists[self._il]) - 1
-        return self
+        if self._adaptive:
+            self._mix[2] += 1
+        return Cursor(self)
 
     def __reversed__(self):
-        self._irev = 1
-        self.__iter__()
+        if self._adaptive:
+            self._mix[2] += 1
+        il = len(self._lists) - 1
+        return Cursor(self, il, len(self._lists[il]) - 1, reverse=1)
+
+    def _default_cursor(self):
+        if self._cursor is None:
+            self._cursor = Cursor(self)
+        return self._cursor
+
+    def __next__(self):
+        return next(self._default_cursor())
+
+    def cursor(self, index=0, reverse=0):
+        if index == len(self):
+            il = len(self._lists) - 1
+            return Cursor(self, il, len(self._lists[il]), reverse)
+        return Cursor(self, *self._index_location(index), reverse=reverse)
+
+    def iter_end(self):
+        return self._default_cursor().iter_end()
+
+    def iter_getitem(self):
+        return self._default_cursor().iter_getitem()
+
+    def iter_del(self):
+        return self._default_cursor().iter_del()
+
+    def lower_bound(self, obj):
+        self._cursor = Cursor(self, *self._obj_location(obj, l=1))
+        return self._cursor
+
+    def upper_bound(self, obj):
+        self._cursor = Cursor(self, *self._obj_location(obj))
+        return self._cursor
+
+
+class Cursor(object):
+    """ Fastlist iterator with its own (sublist, offset) position, kept
+    at its item over the edits made through any handle of the list """
+
+    def __init__(self, fl, il=0, ii=0, reverse=0):
+        self._fl = fl
+        self._rev = reverse
+        self._il = il
+        self._ii = ii
+        self._pos = fl._start(il) + ii
+        self._version = fl._version
+        fl._track(self)
+        self._fix()
+
+    def _moved(self, pos, n, length):
+        # Items inserted before the current item shift it, deleting it
+        # moves to the next item in the iteration order
+        if n > 0:
+            if pos < self._pos or pos == self._pos < length:
+                self._pos += n
+                self._version = None
+        elif pos <= self._pos:
+            if self._pos >= pos - n:
+                self._pos += n
+            else:
+                self._pos = pos - 1 if self._rev else pos
+            self._version = None
+
+    def _fix(self):
+        # Relocate by position after the edits, step over sublist edges
+        lists = self._fl._lists
+        if self._version != self._fl._version:
+            self._version = self._fl._version
+            length = len(self._fl)
+            if self._pos >= length:
+                (self._il, self._ii) = (len(lists) - 1, len(lists[-1]))
+                self._ii += self._pos - length
+            elif self._pos < 0:
+                (self._il, self._ii) = (0, self._pos)
+            else:
+                (self._il, self._ii) = self._fl._index_location(self._pos)
+        while (self._ii >= len(lists[self._il]) and
+                self._il != len(lists) - 1):
+            self._ii -= len(lists[self._il])
+            self._il += 1
+        while self._ii < 0 and self._il != 0:
+            self._il -= 1
+            self._ii += len(lists[self._il])
+
+    def __iter__(self):
         return self
 
-    def _iter_fix(self):
-        if not self._irev:
-            if (self._il != len(self._lists) - 1 and
-                    self._ii == len(self._lists[self._il])):
-                self._il += 1
-                self._ii = 0
-        else:
-            if self._il != 0 and self._ii == -1:
-                self._il -= 1
-                self._ii = len(self._lists[self._il]) - 1
+    def __next__(self):
+        self._fix()
+        lst = self._fl._lists[self._il]
+        if not 0 <= self._ii < len(lst):
+            raise StopIteration("Iteration stopped")
+        item = lst[self._ii]
+        step = -1 if self._rev else 1
+        self._ii += step
+        self._pos += step
+        return item
+
+    def index(self):
+        return self._pos
+
+    def move(self, delta=1):
+        self._ii += delta
+        self._pos += delta
+        return self
+
+    def iter_end(self):
+        self._fix()
+        return not 0 <= self._ii < len(self._fl._lists[self._il])
+
+    def iter_getitem(self):
+        if self.iter_end():
+            raise StopIteration("Iteration stopped")
+        return self._fl._lists[self._il][self._ii]
+
+    def iter_del(self):
+        if self.iter_end():
+            raise IndexError("Cursor out of range")
+        return self._fl._pop_at(self._il, self._ii)
+
+    def iter_insert(self, obj):
+        if self._fl._sorted:
+            raise RuntimeError("No cursor insert to the sorted list")
+        self._fix()
+        end = self._pos >= len(self._fl)
+        self._fl._insert_at(self._il, max(self._ii, 0), obj)
+        if end:
+            self.move(1)
+
+
+class Numlist(Fastlist):
+    """ Sorted Fastlist of numbers with NumPy array sublists """
+
+    def __init__(self, l=[], load=5000, base=Npq, stats=0):
+        Fastlist.__init__(self, load=load, sorted=1, base=base, stats=stats)
+        self.insort_many(l)
+
+    @classmethod
+    def _empty_sorted(cls, **kwargs):
+        return cls(**kwargs)
+
+    def _key_location(self, k, l=0):
+        if self._stats is not None:
+            self._count("bisects", 2)
+        side = "left" if l else "right"
+        il = max(int(numpy.searchsorted(self._mins.view(), k, side)) - 1, 0)
+        ii = int(numpy.searchsorted(self._lists[il].view(), k, side))
+        return (il, ii)
+
+    def insort_many(self, iter):
+        values = numpy.sort(self._base(iter).view())
+        if len(values) == 0:
+            return
+        if len(self._mins) == 0:
+            self._mins.append(values[0])
+        cuts = numpy.searchsorted(values, self._mins.view()[1:], "left")
+        cuts = numpy.concatenate(([0], cuts, [len(values)]))
+        touched = numpy.flatnonzero(numpy.diff(cuts)).tolist()
+        for il in touched:
+            group = values[cuts[il]:cuts[il+1]]
+            if self._cursors:
+                self._merged(il, group)
+            lst = self._lists[il].view()
+            at = numpy.searchsorted(lst, group, "right")
+            self._lists[il] = self._base(numpy.insert(lst, at, group))
+            self._mins[il] = self._lists[il][0]
+            self._shift(il, len(group))
+        for il in reversed(touched):
+            self._split_list(il)
+
+    def count_range(self, lo, hi):
+        """ Number of items in the [lo, hi) range """
+        return max(self._rank(hi) - self._rank(lo), 0)
+
+    def sum_range(self, lo, hi):
+        """ Sum of items in the [lo, hi) range """
+        (il, ii) = self._key_location(lo, l=1)
+        (jl, ji) = self._key_location(hi, l=1)
+        if (il, ii) >= (jl, ji):
+            return 0
+        if il == jl:
+            return self._lists[il].view()[ii:ji].sum().item()
+        result = self._lists[il].view()[ii:].sum()
+        for j in range(il + 1, jl):
+            result += self._lists[j].view().sum()
+        return (result + self._lists[jl].view()[:ji].sum()).item()
+
+    def to_numpy(self):
+        """ Contiguous NumPy array copy of all items """
+        return numpy.concatenate([l.view() for l in self._lists])
+
+
+class Disklist(Fastlist):
+    """ Fastlist with the sublists in pages of a memory mapped file """
+
+    def __init__(self, l=[], load=5000, sorted=0, base=Arrq, indexed=0,
+                 path=None, cache=64):
+        self._path = path
+        self._cachesize = cache
+        Fastlist.__init__(self, load=load, sorted=sorted, base=base,
+                          indexed=indexed)
+        self.clear()
+        self.extend(l)
+
+    def _pages(self, lists):
+        return _Pagedlists(lists, self._base, self._path, self._cachesize,
+                           self._load * 2)
+
+    def _own(self, il):
+        self._lists.mark(il)
+
+    def _empty_like(self):
+        # Result of the set operations, paged to a temporary file since
+        # reopening the path would truncate the pages of this list
+        return type(self)(load=self._load, sorted=self._sorted,
+                          base=self._base, indexed=self._indexed,
+                          cache=self._cachesize)
+
+    def _layout_state(self):
+        return {"cache": self._cachesize}
+
+    def _read(self, buf, lazy=0, trusted=0):
+        # Pages go to a new temporary file, reopening the page file of the
+        # dumped list would truncate it under any list still using it
+        header = Fastlist._read(self, buf, 1, trusted)
+        lists = self._lists
+        cache = header.get("cache", 64)
+        if not isinstance(cache, int) or cache < 1:
+            raise ValueError("Not a valid dumped Disklist")
+        (self._path, self._cachesize) = (None, cache)
+        self._lists = self._keys = self._pages([])
+        for il in range(len(lists)):
+            view = _buffer(list.__getitem__(lists, il))
+            self._lists.insert(il, _from_buffer(self._base, view))
+
+    def _from_attrs(self, state):
+        Fastlist._from_attrs(self, state)
+        self._path = None
+        self._lists = self._keys = self._pages(self._lists)
+
+    def clear(self):
+        if isinstance(self._lists, _Pagedlists):
+            self._lists.close()
+        Fastlist.clear(self)
+        self._lists = self._keys = self._pages(self._lists)
+
+    def close(self):
+        """ Release the page file """
+        self._lists.close()
+
+    def snapshot(self):
+        raise RuntimeError("No snapshots of a disk list")
+
+
+def _no_runs(name):
+    # Fastlist method that has no meaning for the run-length list
+    def method(self, *args, **kwargs):
+        raise RuntimeError("No {} in the run-length list".format(name))
+    method.__name__ = name
+    return method
+
+
+class Runcursor(Cursor):
+    """ Runlist cursor, a position over the expanded items """
+
+    def __init__(self, fl, pos=0, reverse=0):
+        self._fl = fl
+        self._rev = reverse
+        self._pos = pos
 
     def __next__(self):
         item = self.iter_getitem()
-        if not self._irev:
-            self._ii += 1
-        else:
-            self._ii -= 1
+        self._pos += -1 if self._rev else 1
         return item
 
+    def move(self, delta=1):
+        self._pos += delta
+        return self
+
     def iter_end(self):
-        if not self._irev:
-            return (self._il == len(self._lists) - 1 and
-                    self._ii == len(self._lists[self._il]))
-        else:
-            return (self._il == 0 and self._ii == -1)
+        return not 0 <= self._pos < len(self._fl)
 
     def iter_getitem(self):
-        if self.iter_end() or len(self._lists[0]) == 0:
+        if self.iter_end():
             raise StopIteration("Iteration stopped")
-        self._iter_fix()
-        return self._lists[self._il][self._ii]
+        return self._fl[self._pos]
 
     def iter_del(self):
-        item = self._lists[self._il].pop(self._ii)
-        if self._sorted:
-            if self._ii == 0 and len(self._lists[self._il]) > 0:
-                self._mins[self._il] = self._lists[self._il][0]
+        if self.iter_end():
+            raise IndexError("Cursor out of range")
+        item = self._fl.pop(self._pos)
+        if self._rev:
+            self.move(-1)
+        return item
+
+    def iter_insert(self, obj):
+        raise RuntimeError("No cursor insert to the sorted list")
+
+
+class Runlist(Fastlist):
+    """ Sorted Fastlist storing (value, count) runs: sublists hold the
+    distinct values, _counts the parallel run lengths """
+
+    def __init__(self, l=[], load=1000, base=list, stats=0):
+        self._counts = []
+        self._ends = {}
+        Fastlist.__init__(self, load=load, sorted=1, base=base, stats=stats)
+        self._cursor = Runcursor(self)
+        self.insort_many(l)
+
+    @classmethod
+    def _empty_sorted(cls, **kwargs):
+        return cls(**kwargs)
+
+    def _lay_out(self, items, keys=None):
+        self.clear()
+        for (obj, group) in itertools.groupby(items):
+            self._add_run(obj, sum(1 for item in group))
+
+    def _fenwick(self):
+        # Prefix sums of the items, not of the distinct values
+        if self._fw is None:
+            if self._stats is not None:
+                self._count("fenwick_rebuilds")
+            self._fw = Fenwick([sum(c) for c in self._counts])
+        return self._fw
+
+    def _shift(self, il, delta):
+        self._ends.pop(il, None)
+        Fastlist._shift(self, il, delta)
+
+    def _insert_list(self, il):
+        Fastlist._insert_list(self, il)
+        self._counts.insert(il, Arrq())
+        self._ends.clear()
+
+    def _del_list(self, il, num=1):
+        Fastlist._del_list(self, il, num)
+        del self._counts[il:il+num]
+        self._ends.clear()
+
+    def _even_lists(self, il):
+        self._ends.clear()
+        (a, b) = (self._counts[il], self._counts[il+1])
+        tot = len(a) + len(b)
+        if tot < self._load:
+            a += b
         else:
-            for j in range(self._il + 1, len(self._starts)):
-                self._starts[j] -= 1
-        self._rebalance(self._il)
+            ctot = a + b
+            (self._counts[il], self._counts[il+1]) = (
+                ctot[:tot//2], ctot[tot//2:])
+        Fastlist._even_lists(self, il)
+        self._fw = None
+
+    def _split_list(self, il):
+        n = len(self._lists[il])
+        if n >= self._load * 2:
+            num = -(-n // self._load)
+            cuts = [n * k // num for k in range(num + 1)]
+            counts = self._counts[il]
+            self._counts[il:il+1] = [
+                counts[cuts[k]:cuts[k+1]] for k in range(num)]
+            self._ends.clear()
+        Fastlist._split_list(self, il)
+
+    def _run_find(self, obj):
+        # Slot of the run of obj, or of where it would go, and if it's there
+        (il, ii) = self._key_location(obj, l=1)
+        lst = self._lists[il]
+        if ii == len(lst) and il + 1 < len(self._lists):
+            if self._lists[il+1][0] == obj:
+                return (il + 1, 0, True)
+        return (il, ii, ii < len(lst) and lst[ii] == obj)
+
+    def _run_location(self, index):
+        # (sublist, slot, offset in the run) of the item at the index
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("List index out of range")
+        if index == 0:
+            return (0, 0, 0)
+        if index == length - 1:
+            (il, ii) = (len(self._lists) - 1, len(self._lists[-1]) - 1)
+            return (il, ii, self._counts[il][ii] - 1)
+        (il, off) = self._fenwick().search(index)
+        ends = self._run_ends(il)
+        ii = bisect.bisect_right(ends, off)
+        return (il, ii, off - (ends[ii-1] if ii else 0))
+
+    def _run_ends(self, il):
+        # Run ends of the sublist, kept until its counts change
+        ends = self._ends.get(il)
+        if ends is None:
+            ends = self._ends[il] = list(itertools.accumulate(
+                self._counts[il]))
+        return ends
+
+    def _run_start(self, il, ii):
+        return self._start(il) + (self._run_ends(il)[ii-1] if ii else 0)
+
+    def _runs_from(self, il, ii):
+        # Iterator over the (value, count) runs from slot ii of sublist il
+        for j in range(il, len(self._lists)):
+            start = ii if j == il else 0
+            yield from zip(self._lists[j][start:], self._counts[j][start:])
+
+    def _add_run(self, obj, num):
+        if len(self._mins) == 0:
+            self._mins.append(obj)
+        (il, ii, found) = self._run_find(obj)
+        if found:
+            self._counts[il][ii] += num
+            self._shift(il, num)
+            return
+        self._lists[il].insert(ii, obj)
+        self._counts[il].insert(ii, num)
+        if ii == 0:
+            self._mins[il] = obj
+        self._shift(il, num)
+        self._rebalance(il)
+
+    def _del_run(self, il, ii, num):
+        # Drop num items of the run, the slot too once the run is empty
+        if self._counts[il][ii] > num:
+            self._counts[il][ii] -= num
+            self._shift(il, -num)
+            return
+        num = self._counts[il].pop(ii)
+        self._lists[il].pop(ii)
+        if ii == 0 and len(self._lists[il]) > 0:
+            self._mins[il] = self._lists[il][0]
+        self._shift(il, -num)
+        self._rebalance(il)
+
+    def runs(self):
+        """ Iterator over the (value, count) runs """
+        for il in range(len(self._lists)):
+            yield from zip(self._lists[il], self._counts[il])
+
+    def clear(self):
+        (self._counts, self._ends) = ([], {})
+        Fastlist.clear(self)
+
+    def insort(self, obj, l=0):
+        self._add_run(obj, 1)
+
+    def insort_many(self, iter):
+        for (obj, group) in itertools.groupby(sorted(iter)):
+            self._add_run(obj, sum(1 for item in group))
+
+    def append(self, obj):
+        self.insort(obj)
+
+    def extend(self, iter):
+        self.insort_many(iter)
+
+    def pop(self, index=None):
+        (il, ii, rep) = self._run_location(-1 if index is None else index)
+        item = self._lists[il][ii]
+        self._del_run(il, ii, 1)
         return item
 
+    def discard(self, obj):
+        if len(self._lists[0]) == 0:
+            return False
+        (il, ii, found) = self._run_find(obj)
+        if found:
+            self._del_run(il, ii, 1)
+        return found
+
+    def count(self, obj):
+        if len(self._lists[0]) == 0:
+            return 0
+        (il, ii, found) = self._run_find(obj)
+        return self._counts[il][ii] if found else 0
+
+    def index(self, obj):
+        (il, ii, found) = self._run_find(obj)
+        if not found:
+            raise ValueError("{} is not in list".format(obj))
+        return self._run_start(il, ii)
+
+    def _rank(self, k, l=1):
+        (il, ii, found) = self._run_find(k)
+        return self._run_start(il, ii + (found and not l))
+
+    def bisect_many(self, values, right=0):
+        return [self._rank(k, not right) for k in values]
+
+    def count_many(self, values):
+        return [self.count(k) for k in values]
+
+    def contains_many(self, values):
+        return [k in self for k in values]
+
+    def irange_runs(self, lo=None, hi=None, inclusive=(True, False)):
+        """ Iterator over the runs with values between lo and hi """
+        (il, ii) = (0, 0)
+        if lo is not None:
+            (il, ii, found) = self._run_find(lo)
+            ii += found and not inclusive[0]
+        while il < len(self._lists):
+            (lst, counts) = (self._lists[il], self._counts[il])
+            while ii < len(lst):
+                if hi is not None and (
+                        lst[ii] > hi or lst[ii] == hi and not inclusive[1]):
+                    return
+                yield (lst[ii], counts[ii])
+                ii += 1
+            (il, ii) = (il + 1, 0)
+
+    def irange(self, lo=None, hi=None, inclusive=(True, False), reverse=0):
+        items = itertools.chain.from_iterable(itertools.starmap(
+            itertools.repeat, self.irange_runs(lo, hi, inclusive)))
+        return reversed(list(items)) if reverse else items
+
+    def islice(self, start=None, stop=None, reverse=0):
+        (start, stop, step) = slice(start, stop).indices(len(self))
+        items = self._expand(start, stop)
+        return reversed(list(items)) if reverse else items
+
+    def _expand(self, start, stop):
+        # Items in the [start, stop) index range
+        if stop <= start:
+            return iter(())
+        (il, ii, rep) = self._run_location(start)
+        items = itertools.chain.from_iterable(
+            itertools.starmap(itertools.repeat, self._runs_from(il, ii)))
+        return itertools.islice(items, rep, rep + stop - start)
+
+    def _del_range(self, r):
+        # Delete the items at the positions of the range with a positive
+        # step. Runs the range covers are dropped, the others shrunk by
+        # the number of their positions in the range
+        if len(r) == len(self):
+            self.clear()
+            return
+        (il, ii, rep) = self._run_location(r[0])
+        (pos, last, first) = (r[0] - rep, r[-1], il)
+        while pos <= last:
+            (lst, counts) = (self._lists[il], self._counts[il])
+            total = sum(counts)
+            if r.step == 1 and ii == 0 and r[0] <= pos and (
+                    pos + total <= last + 1):
+                # Whole sublist in the range, emptied in O(1)
+                (self._lists[il], self._counts[il]) = (self._base(), Arrq())
+                self._shift(il, -total)
+                (il, pos) = (il + 1, pos + total)
+                continue
+            (values, kept) = (list(lst[:ii]), Arrq(counts[:ii]))
+            removed = 0
+            for j in range(ii, len(counts)):
+                n = counts[j]
+                if pos <= last:
+                    hits = len(r[max(-(-(pos - r.start) // r.step), 0):
+                                 max(-(-(pos + n - r.start) // r.step), 0)])
+                    (n, removed, pos) = (n - hits, removed + hits, pos + n)
+                if n:
+                    values.append(lst[j])
+                    kept.append(n)
+            self._lists[il] = self._base(values)
+            self._counts[il] = kept
+            if values:
+                self._mins[il] = values[0]
+            self._shift(il, -removed)
+            (il, ii) = (il + 1, 0)
+        survivors = []
+        j = il - 1
+        while j >= first:
+            k = j
+            while k >= first and len(self._lists[k]) == 0:
+                k -= 1
+            if k < j:
+                self._del_list(k + 1, j - k)
+            if k >= first:
+                survivors.append(k)
+            j = k - 1
+        for j in survivors:
+            if j < len(self._lists):
+                self._rebalance(j)
+
+    def as_list(self):
+        return list(self)
+
     def lower_bound(self, obj):
-        (self._il, self._ii) = self._obj_location(obj, l=1)
-        return self
+        self._cursor = Runcursor(self, self._rank(obj))
+        return self._cursor
 
     def upper_bound(self, obj):
-        (self._il, self._ii) = self._obj_location(obj)
-        return self
+        self._cursor = Runcursor(self, self._rank(obj, l=0))
+        return self._cursor
+
+    def cursor(self, index=0, reverse=0):
+        return Runcursor(self, index, reverse)
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            (il, ii, rep) = self._run_location(index)
+            return self._lists[il][ii]
+        (start, stop, step) = index.indices(len(self))
+        if step < 0:
+            (start, stop) = (stop + 1, start + 1)
+        return list(self._expand(start, stop))[::step]
+
+    def __contains__(self, obj):
+        return len(self._lists[0]) != 0 and self._run_find(obj)[2]
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(
+            itertools.starmap(itertools.repeat, self.runs()))
+
+    def __reversed__(self):
+        runs = ((self._lists[il][ii], self._counts[il][ii])
+                for il in range(len(self._lists) - 1, -1, -1)
+                for ii in range(len(self._lists[il]) - 1, -1, -1))
+        return itertools.chain.from_iterable(
+            itertools.starmap(itertools.repeat, runs))
+
+    def __getstate__(self):
+        return (self._load, self._base, list(self.runs()))
+
+    def __setstate__(self, state):
+        (load, base, runs) = state
+        Runlist.__init__(self, load=load, base=base)
+        for (obj, num) in runs:
+            self._add_run(obj, num)
+
+    insert = _no_runs("insert")
+    appendleft = _no_runs("appendleft")
+    __setitem__ = _no_runs("item assignment")
+    add_aggregate = _no_runs("aggregates")
+    as_buffer = _no_runs("buffers")
+    buffers = _no_runs("buffers")
+    dump = _no_runs("dump")
+    snapshot = _no_runs("snapshots")
+    _combine_with = _no_runs("set operations")
+
+
+def _exclusive(method):
+    # Concurrentlist method run under the write lock
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        return self._exclusively(method, *args, **kwargs)
+    return locked
+
+
+def _quietly(method):
+    # Concurrentlist method run while no sublist is updated in place
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._quiet():
+            return method(self, *args, **kwargs)
+    return locked
+
+
+def _frozenly(method):
+    # Concurrentlist read run on a private snapshot, the locks are held
+    # only while the snapshot shares the sublists
+    @functools.wraps(method)
+    def read(self, *args, **kwargs):
+        return method(self._frozen(), *args, **kwargs)
+    return read
+
+
+def _optimistic(method):
+    # Concurrentlist read run without locks, repeated quietly if a writer
+    # updated some sublist meanwhile
+    @functools.wraps(method)
+    def read(self, *args):
+        if not self._lock.acquire_read():
+            return method(self, *args)
+        try:
+            seq = self._seq
+            if not self._busy:
+                try:
+                    result = method(self, *args)
+                except Exception:
+                    result = _EMPTY
+                if result is not _EMPTY and seq == self._seq:
+                    return result
+        finally:
+            self._lock.release_read()
+        with self._quiet():
+            return method(self, *args)
+    return read
+
+
+class Concurrentlist(Fastlist):
+    """ Fastlist shared by threads, iterators walk a private snapshot """
+
+    def __init__(self, l=[], load=5000, sorted=0, base=list, key=None,
+                 keybase=list, stripes=16):
+        self._init_locks(stripes)
+        Fastlist.__init__(self, l, load=load, sorted=sorted, base=base,
+                          indexed=1, key=key, keybase=keybase)
+
+    def _init_locks(self, stripes=16):
+        # Write lock for layout changes, stripe locks for the sublists and
+        # the mutex for the Fenwick tree and the other index bookkeeping
+        self._lock = RWLock()
+        self._stripes = [threading.Lock() for i in range(stripes)]
+        self._mutex = threading.Lock()
+        self._local = threading.local()
+        (self._busy, self._seq) = (0, 0)
+
+    def _exclusively(self, method, *args, **kwargs):
+        with self._lock.write():
+            result = method(self, *args, **kwargs)
+            self._fenwick()
+            return result
+
+    @contextlib.contextmanager
+    def _quiet(self):
+        if getattr(self._local, "quiet", 0):
+            yield
+            return
+        with self._lock.read():
+            for stripe in self._stripes:
+                stripe.acquire()
+            self._mutex.acquire()
+            self._local.quiet = 1
+            try:
+                yield
+            finally:
+                self._local.quiet = 0
+                self._mutex.release()
+                for stripe in self._stripes:
+                    stripe.release()
+
+    def _in_place(self, locate, delta, fits, update):
+        # Update one sublist under its stripe lock, the index bookkeeping
+        # goes first under the mutex. _EMPTY if the layout has to change
+        taken = self._lock.acquire_read()
+        try:
+            while True:
+                with self._mutex:
+                    il = locate()[0]
+                with self._stripes[il % len(self._stripes)]:
+                    with self._mutex:
+                        (jl, ii) = locate()
+                        if jl != il:
+                            continue
+                        if not fits(il, ii):
+                            return _EMPTY
+                        self._own(il)
+                        if delta:
+                            self._shift(il, delta)
+                        else:
+                            self._touch(il)
+                        self._busy += 1
+                        self._seq += 1
+                    try:
+                        return update(il, ii)
+                    finally:
+                        with self._mutex:
+                            self._busy -= 1
+                            self._seq += 1
+        finally:
+            if taken:
+                self._lock.release_read()
+
+    def _fits(self, il, delta):
+        # Length after the update needs no _rebalance
+        n = len(self._lists[il]) + delta
+        return (n < self._load * 2 and
+                (n > self._load * 0.2 or len(self._lists) == 1))
+
+    def _put(self, il, ii, obj, k):
+        self._lists[il].insert(ii, obj)
+        if self._key is not None:
+            self._keys[il].insert(ii, k)
+
+    def _take(self, il, ii):
+        if self._key is not None:
+            self._keys[il].pop(ii)
+        return self._lists[il].pop(ii)
+
+    def insert(self, index, obj):
+        if not self._sorted and self._in_place(
+                lambda: self._index_location(index), 1,
+                lambda il, ii: self._fits(il, 1),
+                lambda il, ii: self._put(il, ii, obj, None)) is not _EMPTY:
+            return
+        self._exclusively(Fastlist.insert, index, obj)
+
+    def append(self, obj):
+        k = self._key_of(obj)
+
+        def locate():
+            il = len(self._lists) - 1
+            return (il, len(self._lists[il]))
+
+        if len(self._mins) and self._in_place(
+                locate, 1, lambda il, ii: ii < self._load,
+                lambda il, ii: self._put(il, ii, obj, k)) is not _EMPTY:
+            return
+        self._exclusively(Fastlist.append, obj)
+
+    def insort(self, obj, l=0):
+        k = self._key_of(obj)
+
+        def fits(il, ii):
+            return 0 < ii < len(self._keys[il]) and self._fits(il, 1)
+
+        if len(self._mins) and self._in_place(
+                lambda: self._key_location(k, l), 1, fits,
+                lambda il, ii: self._put(il, ii, obj, k)) is not _EMPTY:
+            return
+        self._exclusively(Fastlist.insort, obj, l)
+
+    def pop(self, index=None):
+        index = -1 if index is None else index
+
+        def fits(il, ii):
+            return self._fits(il, -1) and (ii > 0 or not self._sorted)
+
+        item = self._in_place(
+            lambda: self._index_location(index), -1, fits, self._take)
+        if item is _EMPTY:
+            item = self._exclusively(Fastlist.pop, index)
+        return item
+
+    def __setitem__(self, index, obj):
+        if (isinstance(index, int) and not self._sorted and self._in_place(
+                lambda: self._index_location(index), 0, lambda il, ii: 1,
+                lambda il, ii: self._lists[il].__setitem__(ii, obj))
+                is not _EMPTY):
+            return
+        self._exclusively(Fastlist.__setitem__, index, obj)
+
+    def __delitem__(self, index):
+        if isinstance(index, int):
+            self.pop(index)
+        else:
+            self._exclusively(Fastlist.__delitem__, index)
+
+    extend = _exclusive(Fastlist.extend)
+    clear = _exclusive(Fastlist.clear)
+    insort_many = _exclusive(Fastlist.insort_many)
+    discard = _exclusive(Fastlist.discard)
+    remove_range = _exclusive(Fastlist.remove_range)
+    add_aggregate = _exclusive(Fastlist.add_aggregate)
+    _lay_out = _exclusive(Fastlist._lay_out)
+
+    as_list = _frozenly(Fastlist.as_list)
+    as_buffer = _frozenly(Fastlist.as_buffer)
+    bisect_many = _frozenly(Fastlist.bisect_many)
+    count_many = _frozenly(Fastlist.count_many)
+    contains_many = _frozenly(Fastlist.contains_many)
+    _write = _frozenly(Fastlist._write)
+    _agg_parts = _quietly(Fastlist._agg_parts)
+
+    __getitem__ = _optimistic(Fastlist.__getitem__)
+    __contains__ = _optimistic(Fastlist.__contains__)
+    index = _optimistic(Fastlist.index)
+    count = _optimistic(Fastlist.count)
+
+    def aggregate_range(self, name, lo, hi, default=None):
+        with self._quiet():
+            parts = self._agg_parts(name, self._rank(lo), self._rank(hi))
+        return self._agg_result(parts, default)
+
+    def _combine_with(self, other, count):
+        if isinstance(other, Concurrentlist):
+            other = other._frozen()
+        with self._quiet():
+            return Fastlist._combine_with(self, other, count)
+
+    def _empty_like(self):
+        return type(self)(
+            load=self._load, sorted=self._sorted, base=self._base,
+            key=self._key, keybase=self._keybase,
+            stripes=len(self._stripes))
+
+    def _read(self, buf, lazy=0, trusted=0):
+        self._init_locks()
+        Fastlist._read(self, buf, 0, trusted)
+        self._fw = None
+        self._fenwick()
+
+    def _attrs(self):
+        state = Fastlist._attrs(self._frozen())
+        for name in ["_lock", "_mutex", "_local", "_busy", "_seq"]:
+            del state[name]
+        state["_stripes"] = len(self._stripes)
+        return state
+
+    def _from_attrs(self, state):
+        stripes = state.pop("_stripes")
+        Fastlist._from_attrs(self, state)
+        self._init_locks(stripes)
+
+    def snapshot(self):
+        with self._quiet():
+            result = self._share(type(self))
+        result._init_locks(len(self._stripes))
+        result._fenwick()
+        return result
+
+    def _frozen(self):
+        # Private Fastlist snapshot to walk without any locks
+        with self._quiet():
+            return self._share(Fastlist)
+
+    def __iter__(self):
+        return iter(self._frozen())
+
+    def __reversed__(self):
+        return reversed(self._frozen())
+
+    def cursor(self, index=0, reverse=0):
+        return self._frozen().cursor(index, reverse)
+
+    def irange(self, lo=None, hi=None, inclusive=(True, False), reverse=0):
+        return self._frozen().irange(lo, hi, inclusive, reverse)
+
+    def islice(self, start=None, stop=None, reverse=0):
+        return self._frozen().islice(start, stop, reverse)
+
+    def buffers(self, start=None, stop=None):
+        return self._frozen().buffers(start, stop)
+
+    def _thread_cursor(self):
+        if getattr(self._local, "cursor", None) is None:
+            self._local.cursor = Cursor(self._frozen())
+        return self._local.cursor
+
+    def __next__(self):
+        return next(self._thread_cursor())
+
+    def iter_end(self):
+        return self._thread_cursor().iter_end()
+
+    def iter_getitem(self):
+        return self._thread_cursor().iter_getitem()
+
+    def iter_del(self):
+        return self._thread_cursor().iter_del()
+
+    def lower_bound(self, obj):
+        self._local.cursor = self._frozen().lower_bound(obj)
+        return self._local.cursor
+
+    def upper_bound(self, obj):
+        self._local.cursor = self._frozen().upper_bound(obj)
+        return self._local.cursor
+
+
+class SlidingWindow(object):
+    """ Order statistics of the last items of a stream: count based
+    (size) and/or time based (span) eviction over a sorted Fastlist """
+
+    def __init__(self, size=None, span=None, load=1000, base=list, runs=0):
+        if size is None and span is None:
+            raise RuntimeError("Window needs a size or a time span")
+        self._size = size
+        self._span = span
+        self._values = collections.deque()
+        self._times = collections.deque()
+        if runs:
+            self._items = Runlist(load=load, base=base)
+        else:
+            self._items = Fastlist(load=load, sorted=1, base=base)
+
+    def _now(self, t):
+        if t is None and self._span is not None:
+            return time.monotonic()
+        return t
+
+    def _evict(self, now):
+        # Drop the oldest items beyond the size or the time span
+        (values, times) = (self._values, self._times)
+        expired = []
+        while values and self._size is not None and len(values) > self._size:
+            expired.append(values.popleft())
+            times.popleft()
+        if self._span is not None and now is not None:
+            while times and times[0] <= now - self._span:
+                expired.append(values.popleft())
+                times.popleft()
+        if len(expired) * 2 > len(self._items):
+            # Most of the window expired, cheaper to sort the rest anew
+            self._items.clear()
+            self._items.insort_many(values)
+        else:
+            for obj in expired:
+                self._items.remove(obj)
+
+    def push(self, obj, t=None):
+        """ Add an item arrived at time t (now by default) """
+        now = self._now(t)
+        self._values.append(obj)
+        self._times.append(now)
+        self._items.insort(obj)
+        self._evict(now)
+
+    def push_many(self, objs, t=None):
+        """ Add a batch of items arrived at time t, sorted in one pass """
+        objs = list(objs)
+        now = self._now(t)
+        self._values.extend(objs)
+        self._times.extend([now] * len(objs))
+        self._items.insort_many(objs)
+        self._evict(now)
+
+    def expire(self, t=None):
+        """ Evict the items older than the time span at time t """
+        self._evict(self._now(t))
+
+    def quantile(self, q):
+        """ Item at the q (0 to 1) quantile, linear interpolation between
+        the two nearest numbers """
+        if not len(self._items):
+            raise IndexError("Quantile of an empty window")
+        if not 0 <= q <= 1:
+            raise ValueError("Quantile must be between 0 and 1")
+        pos = q * (len(self._items) - 1)
+        i = int(pos)
+        lo = self._items[i]
+        if pos == i:
+            return lo
+        return lo + (self._items[i + 1] - lo) * (pos - i)
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def select(self, k):
+        """ k-th smallest item of the window """
+        return self._items[k]
+
+    def rank(self, obj):
+        """ Number of items less than obj """
+        return self._items._rank(self._items._key_of(obj))
+
+    def as_list(self):
+        return self._items.as_list()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+
+###############################################################################
+# Benchmark
+###############################################################################
+
+# Default sweep, sizes up to 1e8 can be asked for on the command line
+BENCH_SIZES = (1000, 10000, 100000, 1000000)
+BENCH_LOADS = (1000, 5000)
+BENCH_BASES = ("list", "Arrl", "Arrq")
+BENCH_OPS = ("append", "insert", "pop0", "insort", "bound", "contains",
+             "slice", "iter")
+
+
+def _list_contains(s, v):
+    i = bisect.bisect_left(s, v)
+    return i < len(s) and s[i] == v
+
+
+# Per-item calls of every operation: (needs the sorted structure, call)
+_FASTLIST_OPS = {
+    "append": (0, lambda s, v: s.append(v)),
+    "insert": (0, lambda s, v: s.insert(len(s) // 2, v)),
+    "pop0": (0, lambda s, v: s.pop(0)),
+    "insort": (1, lambda s, v: s.insort(v)),
+    "bound": (1, lambda s, v: s.lower_bound(v)),
+    "contains": (1, lambda s, v: v in s),
+    "slice": (0, lambda s, v: s[v // 2:v // 2 + 100]),
+    "iter": (0, None)}
+_BISECT_OPS = {
+    "append": (0, lambda s, v: s.append(v)),
+    "insert": (0, lambda s, v: s.insert(len(s) // 2, v)),
+    "pop0": (0, lambda s, v: s.pop(0)),
+    "insort": (1, bisect.insort),
+    "bound": (1, bisect.bisect_left),
+    "contains": (1, _list_contains),
+    "slice": (0, lambda s, v: s[v // 2:v // 2 + 100]),
+    "iter": (0, None)}
+_SORTEDCONTAINERS_OPS = {
+    "pop0": (1, lambda s, v: s.pop(0)),
+    "insort": (1, lambda s, v: s.add(v)),
+    "bound": (1, lambda s, v: s.bisect_left(v)),
+    "contains": (1, lambda s, v: v in s),
+    "slice": (1, lambda s, v: s[v // 2:v // 2 + 100]),
+    "iter": (1, None)}
+
+
+_BENCH_BASES = {"list": list, "Arrl": Arrl, "Arrq": Arrq}
+
+
+def _fastlist_factory(base, load):
+    return lambda items, srt: Fastlist(items, load, sorted=srt, base=base)
+
+
+def bench_targets(loads=BENCH_LOADS, bases=BENCH_BASES, refs=1):
+    """ Structures to benchmark: name -> (factory(items, sorted), ops) """
+    targets = collections.OrderedDict()
+    for base in bases:
+        for load in loads:
+            targets["Fastlist/%s/%d" % (base, load)] = (
+                _fastlist_factory(_BENCH_BASES[base], load), _FASTLIST_OPS)
+    if refs:
+        targets["bisect"] = (lambda items, srt: list(items), _BISECT_OPS)
+        try:
+            import sortedcontainers
+            targets["sortedcontainers"] = (
+                lambda items, srt: sortedcontainers.SortedList(items),
+                _SORTEDCONTAINERS_OPS)
+        except ImportError:
+            pass
+    return targets
+
+
+def _bench_rate(call, s, vals, budget):
+    # Items per second of the call over vals, stopped after budget seconds
+    if call is None:
+        start = time.perf_counter()
+        collections.deque(s, maxlen=0)
+        return len(s) / max(time.perf_counter() - start, 1e-9)
+    (done, start, elapsed) = (0, time.perf_counter(), 0)
+    while done < len(vals) and elapsed < budget:
+        for v in vals[done:done + 64]:
+            call(s, v)
+        done = min(done + 64, len(vals))
+        elapsed = time.perf_counter() - start
+    return done / max(elapsed, 1e-9)
+
+
+def _bench_peak(factory, items, srt):
+    # Peak bytes allocated while building a structure, which is dropped:
+    # tracing slows the allocations down too much to time the same build
+    tracemalloc.start()
+    try:
+        factory(items, srt)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(sizes=BENCH_SIZES, loads=BENCH_LOADS, bases=BENCH_BASES,
+              ops=BENCH_OPS, refs=1, count=10000, budget=0.5, seed=1):
+    """ Runs the benchmark sweep, returns a list of result dicts with
+    the target, op, size, ops/sec and peak memory of the build. Every
+    structure is built twice: once traced for the peak memory and once
+    untraced for the build time and the operations """
+    rnd = random.Random(seed)
+    result = []
+    for n in sizes:
+        items = range(0, 2 * n, 2)
+        # At most n/2 calls so that pop0 keeps the size representative
+        vals = [rnd.randrange(2 * n) for i in range(min(count, n // 2))]
+        for (name, (factory, table)) in bench_targets(
+                loads, bases, refs).items():
+            built = {}
+            for op in ops:
+                if op not in table:
+                    continue
+                (srt, call) = table[op]
+                if srt not in built:
+                    peak = _bench_peak(factory, items, srt)
+                    start = time.perf_counter()
+                    built[srt] = factory(items, srt)
+                    result.append({
+                        "target": name, "size": n,
+                        "op": "build_sorted" if srt else "build",
+                        "ops": n / max(time.perf_counter() - start, 1e-9),
+                        "mem": peak})
+                result.append({
+                    "target": name, "op": op, "size": n, "mem": None,
+                    "ops": _bench_rate(call, built[srt], vals, budget)})
+    return result
+
+
+def _bench_key(row):
+    return "%s %s %d" % (row["target"], row["op"], row["size"])
+
+
+def bench_save(result, path):
+    """ Stores the results as a JSON baseline """
+    with open(path, "w") as f:
+        json.dump({_bench_key(r): {"ops": r["ops"], "mem": r["mem"]}
+                   for r in result}, f, indent=1, sort_keys=True)
+
+
+def bench_compare(result, baseline, tolerance=0.2):
+    """ Regressions against the baseline (dict or JSON path): a list of
+    (key, field, old, new) for ops/sec drops and peak memory growth
+    beyond the tolerance """
+    if isinstance(baseline, str):
+        with open(baseline) as f:
+            baseline = json.load(f)
+    regressions = []
+    for r in result:
+        old = baseline.get(_bench_key(r))
+        if old is None:
+            continue
+        if r["ops"] < old["ops"] * (1 - tolerance):
+            regressions.append((_bench_key(r), "ops", old["ops"], r["ops"]))
+        if (r["mem"] is not None and old["mem"] is not None and
+                r["mem"] > old["mem"] * (1 + tolerance)):
+            regressions.append((_bench_key(r), "mem", old["mem"], r["mem"]))
+    return regressions
+
+
+def bench_report(result, baseline=None, out=None):
+    """ Prints the results table, with the change vs baseline if given """
+    out = out or sys.stdout
+    out.write("%-24s %-12s %10s %14s %10s %8s\n" % (
+        "Target", "Op", "Size", "Ops/sec", "Peak MB", "Change"))
+    for r in result:
+        old = (baseline or {}).get(_bench_key(r))
+        change = "" if old is None else "%+.0f%%" % (
+            100.0 * (r["ops"] - old["ops"]) / old["ops"])
+        mem = "" if r["mem"] is None else "%.1f" % (r["mem"] / 2**20)
+        out.write("%-24s %-12s %10d %14.0f %10s %8s\n" % (
+            r["target"], r["op"], r["size"], r["ops"], mem, change))
+
+
+def main(argv=None):
+    """ Command line: fastlist.py -bench [-sizes 1e3 1e8] [-baseline F] """
+    p = argparse.ArgumentParser(description="Fastlist benchmark")
+    p.add_argument("-bench", action="store_true", help="run the benchmark")
+    p.add_argument("-sizes", nargs="+", type=lambda s: int(float(s)),
+                   default=BENCH_SIZES)
+    p.add_argument("-loads", nargs="+", type=int, default=BENCH_LOADS)
+    p.add_argument("-bases", nargs="+", choices=BENCH_BASES,
+                   default=BENCH_BASES)
+    p.add_argument("-ops", nargs="+", choices=BENCH_OPS, default=BENCH_OPS)
+    p.add_argument("-count", type=int, default=10000,
+                   help="max calls per operation")
+    p.add_argument("-budget", type=float, default=0.5,
+                   help="max seconds per operation")
+    p.add_argument("-baseline", help="JSON baseline to compare with")
+    p.add_argument("-save", help="store the results as a JSON baseline")
+    p.add_argument("-tolerance", type=float, default=0.2)
+    args = p.parse_args(argv)
+    if not args.bench:
+        return 0
+
+    result = benchmark(args.sizes, args.loads, args.bases, args.ops,
+                       count=args.count, budget=args.budget)
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    bench_report(result, baseline)
+    if args.save:
+        bench_save(result, args.save)
+    if baseline is not None:
+        regressions = bench_compare(result, baseline, args.tolerance)
+        for (key, field, old, new) in regressions:
+            print("REGRESSION %s %s: %.0f -> %.0f" % (key, field, old, new))
+        return 1 if regressions else 0
+    return 0
+
 
 ###############################################################################
 # Unit Tests
@@ -323,24 +3590,104 @@ class unitTests(unittest.TestCase):
             d.add((i // 100 + i % 100) * 2)
             d.pop(0)
 
+    def _tempdir(self):
+        # Temporary directory removed after the test
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        return tmp.name
+
+    def test_Fastlist_class__benchmark(self):
+        """ Benchmark sweep, baseline storage and regression check """
+        result = benchmark(sizes=(200,), loads=(50,), count=50, budget=0.01)
+        ops = {(r["target"], r["op"]) for r in result}
+        for base in BENCH_BASES:
+            for op in BENCH_OPS + ("build", "build_sorted"):
+                self.assertIn(("Fastlist/%s/50" % base, op), ops)
+        self.assertIn(("bisect", "insert"), ops)
+        self.assertTrue(all(r["ops"] > 0 for r in result))
+        self.assertTrue(all(r["mem"] > 0 for r in result
+                            if r["op"].startswith("build")))
+
+        # Stored baseline round trip and regressions against it
+        path = os.path.join(self._tempdir(), "bench.json")
+        bench_save(result, path)
+        self.assertEqual(bench_compare(result, path), [])
+        slower = [dict(r, ops=r["ops"] / 2) for r in result]
+        regressions = bench_compare(slower, path)
+        self.assertEqual(len(regressions), len(result))
+        self.assertEqual(regressions[0][1], "ops")
+        bigger = [dict(r, mem=r["mem"] and r["mem"] * 2) for r in result]
+        fields = [f for (k, f, o, n) in bench_compare(bigger, path)]
+        self.assertTrue(fields and set(fields) == {"mem"})
+        out = io.StringIO()
+        with open(path) as f:
+            bench_report(result, json.load(f), out)
+        self.assertIn("Fastlist/Arrq/50", out.getvalue())
+        self.assertIn("+0%", out.getvalue())
+
+        # Command line run, saved and checked against the baseline
+        args = ["-bench", "-sizes", "100", "-loads", "20", "-bases", "Arrq",
+                "-ops", "append", "bound", "-count", "20", "-budget", "0.01"]
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(main(args + ["-save", path]), 0)
+        self.assertIn("Fastlist/Arrq/20", out.getvalue())
+        with open(path) as f:
+            saved = json.load(f)
+        self.assertIn("Fastlist/Arrq/20 bound 100", saved)
+        self.assertIn("bisect build_sorted 100", saved)
+        for row in saved.values():
+            row["ops"] *= 1000
+        with open(path, "w") as f:
+            json.dump(saved, f)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(main(args + ["-baseline", path]), 1)
+        self.assertIn("REGRESSION Fastlist/Arrq/20 append 100 ops",
+                      out.getvalue())
+        self.assertEqual(main(["-sizes", "10"]), 0)
+
+    def test_Fenwick_class__basic_functionality(self):
+        """ Fenwick class prefix sums and search """
+        l = [3, 0, 2, 5, 1]
+        f = Fenwick(l)
+        self.assertEqual(f.total, 11)
+        self.assertEqual([f.prefix(i) for i in range(6)], [0, 3, 3, 5, 10, 11])
+        self.assertEqual(f.search(0), (0, 0))
+        self.assertEqual(f.search(3), (2, 0))
+        self.assertEqual(f.search(10), (4, 0))
+
+        # Updates and appends keep the prefix sums in sync
+        f.add(1, 4)
+        f.append(7)
+        l[1] += 4
+        l.append(7)
+        self.assertEqual(f.total, sum(l))
+        for i in range(len(l) + 1):
+            self.assertEqual(f.prefix(i), sum(l[:i]))
+        for i in range(sum(l)):
+            (j, off) = f.search(i)
+            self.assertEqual(sum(l[:j]) + off, i)
+            self.assertTrue(off < l[j])
+
     def test_Fastlist_class__basic_functionality(self):
         """ Fastlist class basic unsorted testing """
 
         # Basic internal structure - list of lists with same avg. size
         d = Fastlist([1, 2, 4, 3], load=4)
         self.assertEqual(list(map(list, d._lists)), [[1, 2, 4, 3]])
-        self.assertEqual(list(d._starts), [0])
+        self.assertEqual(d._true_starts(), [0])
 
         # Appending more items, making sure that list is splitted once its
         # size is more than load
         d.append(6)
         self.assertEqual(list(map(list, d._lists)), [[1, 2, 4, 3], [6]])
-        self.assertEqual(list(d._starts), [0, 4])
+        self.assertEqual(d._true_starts(), [0, 4])
 
         # Appending more to make sure that list is splitted one more time
         for i in range(5):
             d.append(1)
-        self.assertEqual(list(d._starts), [0, 4, 8])
+        self.assertEqual(d._true_starts(), [0, 4, 8])
 
         # Checking length
         self.assertEqual(len(d), 10)
@@ -412,6 +3759,45 @@ class unitTests(unittest.TestCase):
         d.extend([i for i in range(100)])
         self.assertEqual(d[-1], 99)
 
+    def test_Fastlist_class__bulk(self):
+        """ Bulk extend and insort_many """
+
+        # Extend fills whole sublists
+        for load in [1, 3, 7]:
+            for indexed in [0, 1]:
+                l = [random.randint(0, 100) for n in range(50)]
+                d = Fastlist(l[:4], load=load, indexed=indexed)
+                d.extend(l[4:])
+                self.assertEqual(list(map(len, d._lists[:-1])),
+                                 [load] * (len(d._lists) - 1))
+                if not indexed:
+                    self.assertEqual(
+                        d._true_starts(), list(range(0, len(l), load)))
+                self.assertEqual(len(d), len(l))
+                self.assertEqual(d[len(l) // 2], l[len(l) // 2])
+
+        # Batch insort merges and splits only the touched sublists
+        l = sorted([random.randint(0, 1000) for n in range(100)])
+        d = Fastlist(l, load=10, sorted=1)
+        for batch in [[], [5], [random.randint(-10, 1010) for n in range(500)],
+                      [500] * 100]:
+            d.insort_many(batch)
+            l = sorted(l + batch)
+            self.assertEqual(d.as_list(), l)
+            self.assertEqual(len(d), len(l))
+            self.assertEqual(d[len(l) // 3], l[len(l) // 3])
+            self.assertTrue(max(map(len, d._lists)) < 20)
+            for il in range(1, len(d._lists)):
+                self.assertTrue(d._lists[il-1][-1] <= d._mins[il])
+                self.assertTrue(d._mins[il] <= d._lists[il][0])
+
+        # Empty list and array base
+        d = Fastlist(load=4, sorted=1, base=Arrq)
+        d.insort_many(range(20, 0, -1))
+        self.assertEqual(d.as_list(), list(range(1, 21)))
+        d.insort(0)
+        self.assertEqual(d[0], 0)
+
     def test_Fastlist_class__pop(self):
         """ Pop. Return element and remove from the list """
 
@@ -442,12 +3828,8 @@ class unitTests(unittest.TestCase):
         except IndexError:
             pass
 
-        # Check for index exception
-        try:
-            Fastlist([1, 2, 3], load=2, sorted=1).pop(1)
-            self.assertTrue(0)
-        except RuntimeError:
-            pass
+        # Pop by rank
+        self.assertEqual(Fastlist([1, 2, 3], load=2, sorted=1).pop(1), 2)
 
     def test_Fastlist_class__clear(self):
         """ Clear. Clear all lists """
@@ -479,6 +3861,614 @@ class unitTests(unittest.TestCase):
         d.extend(l)
         self.assertEqual(d.as_list(), l)
 
+    def test_Fastlist_class__buffers(self):
+        """ Buffers. Memoryview export of array sublists """
+        l = list(range(-50, 50))
+        d = Fastlist(l, load=8, base=Arrq)
+        b = d.as_buffer()
+        self.assertEqual(b.format, "q")
+        self.assertEqual(b.tolist(), l)
+        self.assertTrue(all(len(v) <= 8 for v in d.buffers()))
+        for (i, j) in [(None, None), (3, 40), (8, 16), (-10, None), (5, 5)]:
+            result = []
+            for v in d.buffers(i, j):
+                result.extend(v.tolist())
+                v.release()
+            self.assertEqual(result, l[i:j])
+        d.append(50)
+        self.assertEqual(d[-1], 50)
+        self.assertEqual(bytes(d.as_buffer()), bytes(Arrq(l + [50])))
+        self.assertRaises(TypeError, Fastlist(l).as_buffer)
+
+        """ Sorted list """
+        d = Fastlist(load=8, sorted=1, base=Arrl)
+        d.insort_many(reversed(l))
+        self.assertEqual(d.as_buffer().tolist(), l)
+        self.assertEqual(b"".join(d.buffers()), bytes(Arrl(l)))
+
+    def test_Fastlist_class__dump(self):
+        """ Dump and load. Binary layout, lazy memory mapped loading """
+        path = os.path.join(self._tempdir(), "fastlist.bin")
+        l = list(range(-100, 100))
+        for base in [list, Arrl, Arrq]:
+            d = Fastlist(l, load=8, base=base)
+            d.add_aggregate("sum")
+            d.dump(path)
+            for lazy in [0, 1]:
+                e = Fastlist.load(path, lazy)
+                self.assertEqual(e.as_list(), l)
+                self.assertEqual(e[150], l[150])
+                self.assertEqual(e.aggregate("sum"), sum(l))
+                e.insert(10, 1000)
+                del(e[20:30])
+                self.assertEqual(e.as_list(), l[:10] + [1000] + l[10:19] +
+                                 l[29:])
+            e = pickle.loads(pickle.dumps(d))
+            self.assertEqual(e.as_list(), l)
+            self.assertEqual(type(e._lists[0]), base)
+
+            # Indexed unsorted lists don't keep the starts up to date
+            d = Fastlist(l, load=8, base=base, indexed=1)
+            d.insert(3, 7)
+            d.dump(path)
+            self.assertEqual(Fastlist.load(path).as_list(), d.as_list())
+            self.assertEqual(copy.deepcopy(d).as_list(), d.as_list())
+
+        """ Sorted list """
+        d = Fastlist(load=8, sorted=1, base=Arrq)
+        d.insort_many(l)
+        d.dump(path)
+        e = Fastlist.load(path)
+        self.assertEqual(e.index(50), 150)
+        self.assertLessEqual(sum(type(l) is Arrq for l in e._lists), 2)
+        s = e.snapshot()
+        e.insort(7)
+        self.assertEqual(e.count_many([7])[0], 2)
+        self.assertEqual(s.as_list(), l)
+        self.assertEqual(pickle.loads(pickle.dumps(s)).as_list(), l)
+        d = Fastlist(l, sorted=1, key=lambda n: -n)
+        self.assertRaises(RuntimeError, d.dump, path)
+
+        # Items JSON would change or can't store are rejected
+        d = Fastlist([None, "a", 1.5, [1, {"b": 2}]], load=2)
+        d.dump(path)
+        self.assertEqual(Fastlist.load(path).as_list(), d.as_list())
+        for items in [[(1, 2)], [{1: 2}], [{3}], [[1, (2,)]]]:
+            d = Fastlist(items, sorted=1)
+            self.assertRaises(RuntimeError, d.dump, path)
+            self.assertEqual(pickle.loads(pickle.dumps(d)).as_list(), items)
+        with open(path, "wb") as f:
+            f.write(b"LISTFAST" + bytes(8))
+        self.assertRaises(ValueError, Fastlist.load, path)
+
+        # All sublists loaded, the lazy container is dropped
+        d = Fastlist(l, load=8, base=Arrq)
+        d.dump(path)
+        e = Fastlist.load(path)
+        self.assertIsInstance(e._lists, _Lazylists)
+        e.pop(0)
+        del(e[50:100])
+        self.assertEqual(e.as_list(), l[1:51] + l[101:])
+        self.assertEqual(sum(e), sum(l[1:51] + l[101:]))
+        self.assertIs(type(e._lists), list)
+
+        # Custom aggregates can't be stored, names are checked
+        d.add_aggregate("odd", lambda a, b: a + b, lambda s: len(s))
+        self.assertRaises(RuntimeError, d.dump, path)
+
+        # Lists the layout can't store are pickled by their attributes
+        e = copy.deepcopy(d)
+        e.append(5)
+        self.assertEqual((len(e), len(d)), (len(d) + 1, len(d)))
+        self.assertEqual(e.aggregate("odd"), len(e))
+        d = Fastlist(load=8, sorted=1, key=operator.neg)
+        d.insort_many(l)
+        for e in [pickle.loads(pickle.dumps(d)), copy.deepcopy(d)]:
+            e.insort(500)
+            self.assertEqual(e.as_list(), [500] + sorted(l, reverse=True))
+        self.assertEqual(d.as_list(), sorted(l, reverse=True))
+
+        # Untrusted files with pickled items or a broken header
+        d = Fastlist(l, load=8)
+        with open(path, "wb") as f:
+            d._write(f, objects="pickle")
+        self.assertRaises(ValueError, Fastlist.load, path)
+        with open(path, "wb") as f:
+            d._write(f)
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 8)
+        self.assertRaises(ValueError, Fastlist.load, path)
+
+    def test_Fastlist_class__from_unsorted(self):
+        """ Bulk sorted construction by a process pool """
+        l = [random.randint(0, 1000) for i in range(3000)]
+        for (base, key) in [(list, None), (list, abs), (Arrq, None)]:
+            for workers in [1, 3]:
+                d = Fastlist.from_unsorted(l, workers=workers, min_items=0,
+                                           load=100, base=base, key=key)
+                self.assertEqual(list(d), sorted(l))
+                self.assertEqual(list(map(len, d._lists)), [100] * 30)
+                self.assertEqual(list(d._mins), [s[0] for s in d._lists])
+                self.assertEqual(d.count(l[0]), l.count(l[0]))
+                d.insort(1001)
+                self.assertEqual(d[-1], 1001)
+        d = Runlist.from_unsorted(
+            [x % 7 for x in l], workers=2, min_items=0, load=4)
+        self.assertEqual(len(list(d.runs())), 7)
+        self.assertEqual(list(d), sorted(x % 7 for x in l))
+        self.assertEqual(
+            len(Fastlist.from_unsorted([], workers=2, min_items=0)), 0)
+        self.assertEqual(list(Fastlist.from_unsorted(l, workers=2)), sorted(l))
+        d = Fastlist.from_unsorted(l, workers=2, min_items=0, key=lambda x: -x)
+        self.assertEqual(list(d), sorted(l, reverse=True))
+
+    def test_Disklist_class__basic_functionality(self):
+        """ Disk list. Sublists paged to a file with an LRU cache """
+        path = os.path.join(self._tempdir(), "pages.bin")
+        d = Disklist(range(200), load=4, cache=4, path=path)
+        l = list(range(200))
+        self.assertTrue(os.path.getsize(path) > 0)
+        self.assertEqual(d._lists.resident(), 4)
+        for i in range(0, 180, 7):
+            d.insert(i, -i)
+            l.insert(i, -i)
+            self.assertEqual(d.pop(i + 3), l.pop(i + 3))
+            d[i + 1] = i
+            l[i + 1] = i
+        del(d[50:90])
+        del(l[50:90])
+        self.assertEqual(d[100], l[100])
+        self.assertEqual(d.as_list(), l)
+        self.assertEqual(d._lists.resident(), 4)
+        d.clear()
+        self.assertEqual(len(d), 0)
+        d.extend(l)
+
+        # Pickles keep the cache size and page to a new temporary file
+        for e in [pickle.loads(pickle.dumps(d)), copy.deepcopy(d)]:
+            self.assertEqual((e._path, e._cachesize), (None, 4))
+            self.assertEqual(e.as_list(), l)
+            e.append(-1)
+            e.close()
+        self.assertEqual(d.as_list(), l)
+        d.close()
+        self.assertRaises(RuntimeError, Disklist, base=list)
+
+        """ Sorted list """
+        d = Disklist(load=4, sorted=1, cache=4)
+        d.insort_many(reversed(range(100)))
+        for n in range(0, 100, 3):
+            d.insort(n)
+        l = sorted(list(range(100)) + list(range(0, 100, 3)))
+        self.assertEqual(d.as_list(), l)
+        self.assertEqual(d.index(50), l.index(50))
+        self.assertEqual(list(d.irange(10, 20)), l[l.index(10):l.index(20)])
+        self.assertRaises(RuntimeError, d.snapshot)
+
+        # Set operations page the result to a file of its own
+        e = d.union(Disklist(range(50, 150), load=4, sorted=1))
+        self.assertIsInstance(e, Disklist)
+        self.assertEqual(e.as_list(), l + list(range(100, 150)))
+        self.assertEqual(d.difference(e).as_list(), [])
+        self.assertEqual(d.as_list(), l)
+        d.dump(os.path.join(os.path.dirname(path), "dump.bin"))
+        e = Disklist.load(os.path.join(os.path.dirname(path), "dump.bin"))
+        self.assertEqual((e._path, e._cachesize), (None, 4))
+        self.assertEqual(e.as_list(), l)
+
+    def test_Runlist_class__basic_functionality(self):
+        """ Run-length sorted list against a plain sorted list """
+        d = Runlist(load=3)
+        l = []
+        for i in range(600):
+            x = random.randint(0, 20)
+            sel = random.randint(0, 4)
+            if sel <= 1:
+                d.insort(x)
+                bisect.insort(l, x)
+            elif sel == 2 and l:
+                j = random.randint(-len(l), len(l) - 1)
+                self.assertEqual(d.pop(j), l.pop(j))
+            elif sel == 3:
+                self.assertEqual(d.discard(x), x in l)
+                if x in l:
+                    l.remove(x)
+            elif random.randint(0, 5) == 0:
+                d.remove_range(x, x + 3)
+                l = [v for v in l if not x <= v < x + 3]
+            self.assertEqual(len(d), len(l))
+            self.assertEqual(d.count(x), l.count(x))
+            self.assertEqual(d.lower_bound(x).index(),
+                             bisect.bisect_left(l, x))
+            self.assertEqual(d.upper_bound(x).index(),
+                             bisect.bisect_right(l, x))
+            if l:
+                j = random.randint(0, len(l) - 1)
+                self.assertEqual(d[j], l[j])
+                self.assertEqual(d[j:j + 7], l[j:j + 7])
+        self.assertEqual(list(d), l)
+        self.assertEqual(list(reversed(d)), l[::-1])
+        self.assertEqual(list(d.irange(5, 10)),
+                         [v for v in l if 5 <= v < 10])
+
+        # Slice deletion drops whole runs, trims the boundary ones
+        d = Runlist([i // 10 for i in range(1000)], load=4)
+        l = list(d)
+        for (a, b, step) in [(15, 985, 1), (3, 25, 3), (None, None, -4)]:
+            del(d[a:b:step])
+            del(l[a:b:step])
+            self.assertEqual(list(d), l)
+            self.assertEqual(len(d), len(l))
+        self.assertEqual(list(d.runs()), [(0, 5), (1, 3), (98, 2), (99, 6)])
+        self.assertEqual(d[5:9], l[5:9])
+
+        # Storage grows with the distinct values only
+        d = Runlist([i // 100 + i % 100 for i in range(10000)], load=50)
+        self.assertEqual(len(d), 10000)
+        self.assertEqual(sum(map(len, d._lists)), 199)
+        self.assertEqual(list(d.runs())[:2], [(0, 1), (1, 2)])
+        self.assertEqual(d.index(5), 15)
+        it = d.lower_bound(198)
+        self.assertEqual((next(it), d.iter_end()), (198, True))
+        self.assertEqual(list(pickle.loads(pickle.dumps(d))), list(d))
+        self.assertRaises(RuntimeError, d.insert, 0, 1)
+        self.assertRaises(RuntimeError, d.snapshot)
+
+    def test_SlidingWindow_class__basic_functionality(self):
+        """ Rolling order statistics with count and time eviction """
+        for runs in [0, 1]:
+            w = SlidingWindow(size=51, load=4, runs=runs)
+            l = []
+            for i in range(500):
+                if i % 100 == 0:
+                    batch = [random.randint(0, 40) for j in range(70)]
+                    w.push_many(batch)
+                    l.extend(batch)
+                else:
+                    x = random.randint(0, 40)
+                    w.push(x)
+                    l.append(x)
+                l = l[-51:]
+                s = sorted(l)
+                self.assertEqual(len(w), len(l))
+                self.assertEqual(w.median(), s[25])
+                self.assertEqual(w.quantile(0.1), s[5])
+                self.assertEqual(w.select(-1), s[-1])
+                self.assertEqual(w.rank(20), bisect.bisect_left(s, 20))
+            self.assertEqual(w._items._cursors, {})
+            self.assertEqual(list(w), l)
+            self.assertEqual(w.as_list(), s)
+
+        # Time span eviction and interpolated quantiles
+        w = SlidingWindow(span=10)
+        for t in range(100):
+            w.push(t, t=t)
+        self.assertEqual(w.as_list(), list(range(90, 100)))
+        self.assertEqual(w.median(), 94.5)
+        w.expire(t=105)
+        self.assertEqual(w.as_list(), [96, 97, 98, 99])
+        self.assertEqual(w.quantile(1 / 3), 97)
+        w.push_many([3, 1, 2], t=200)
+        self.assertEqual((len(w), w.quantile(0.25)), (3, 1.5))
+        self.assertRaises(ValueError, w.quantile, 2)
+        self.assertRaises(IndexError, SlidingWindow(size=2).median)
+        self.assertRaises(RuntimeError, SlidingWindow)
+
+    def test_RWLock_class__basic_functionality(self):
+        """ Readers-writer lock. Shared reads, exclusive reentrant writes """
+        lock = RWLock()
+        with lock.read():
+            with lock.read():
+                self.assertTrue(lock.held())
+            self.assertRaises(RuntimeError, lock.write().__enter__)
+        with lock.write():
+            with lock.read(), lock.write():
+                self.assertTrue(lock.held())
+        self.assertFalse(lock.held())
+
+        result = []
+        with lock.write():
+            t = threading.Thread(target=lambda: lock.read().__enter__() or
+                                 result.append(1))
+            t.start()
+            t.join(0.05)
+            self.assertEqual(result, [])
+        t.join()
+        self.assertEqual(result, [1])
+
+    def test_Concurrentlist_class__basic_functionality(self):
+        """ Concurrent list. Threads updating and reading one list """
+        for (srt, key) in [(0, None), (1, None), (1, lambda n: -n)]:
+            d = Concurrentlist(load=20, sorted=srt, key=key)
+            d.add_aggregate("sum")
+            d += range(1000)
+            added = [[] for t in range(4)]
+            popped = [[] for t in range(4)]
+
+            def writer(t):
+                r = random.Random(t)
+                for i in range(300):
+                    if r.random() < 0.6:
+                        n = r.randrange(1000)
+                        added[t].append(n)
+                        if srt:
+                            d.insort(n)
+                        else:
+                            d.insert(r.randrange(len(d)), n)
+                    else:
+                        popped[t].append(d.pop(r.randrange(len(d))))
+
+            def reader(t):
+                for i in range(300):
+                    d[i] in d
+                    d.aggregate("sum", i, i + 200)
+                    if i % 100 == 0:
+                        l = list(d)
+                        if srt:
+                            self.assertEqual(l, d._frozen().as_list())
+                            self.assertEqual(len(d.bisect_many(l)), len(l))
+
+            threads = [threading.Thread(target=writer, args=(t,))
+                       for t in range(4)]
+            threads += [threading.Thread(target=reader, args=(t,))
+                        for t in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            l = list(range(1000)) + sum(added, [])
+            for n in sum(popped, []):
+                l.remove(n)
+            self.assertEqual(sorted(d.as_list()), sorted(l))
+            if srt:
+                self.assertEqual(d.as_list(), sorted(l, key=key))
+            self.assertEqual(len(d), len(l))
+            self.assertEqual(d._fw.total, sum(map(len, d._lists)))
+            self.assertEqual(d.aggregate("sum"), sum(l))
+            self.assertEqual(d.aggregate("sum", 3, 250),
+                             sum(d.as_list()[3:250]))
+            if srt and key is None:
+                self.assertEqual(d.aggregate_range("sum", 100, 300),
+                                 sum(n for n in l if 100 <= n < 300))
+                self.assertEqual(d.aggregate_range("sum", 5, 5, -1), -1)
+
+        """ Iterators and cursors walk a snapshot """
+        d = Concurrentlist(range(100), load=10, sorted=1)
+        it = iter(d)
+        d.pop(0)
+        d.insort(50)
+        self.assertEqual(list(it), list(range(100)))
+        self.assertEqual(d.upper_bound(50).iter_getitem(), 51)
+        self.assertEqual(next(d), 51)
+        s = d.snapshot()
+        d.clear()
+        self.assertEqual(len(s), 100)
+        self.assertEqual(len(pickle.loads(pickle.dumps(s))), 100)
+        self.assertEqual(type(s.merge(s)), Concurrentlist)
+
+    def test_Fastlist_class__stats(self):
+        """ Instrumentation counters, hook and operation timing """
+        events = []
+        d = Fastlist(range(100), load=4,
+                     stats=lambda e, n: events.append((e, n)))
+        for i in range(50):
+            d.pop(0)
+        d.insert(3, 7)
+        self.assertEqual(d[3], 7)
+        st = d.stats()
+        self.assertEqual(st["load"], 4)
+        self.assertEqual(sum(st["sizes"].values()), st["sublists"])
+        self.assertTrue(st["counters"]["merges"] > 0)
+        self.assertTrue(0 < st["counters"]["starts_fixups"] < 100)
+        self.assertEqual(st["ops"]["pop"][0], 50)
+        self.assertEqual(st["ops"]["__getitem__"][0], 1)
+        self.assertTrue(st["ops"]["pop"][1] > 0)
+        for (name, num) in st["counters"].items():
+            self.assertEqual(sum(n for (e, n) in events if e == name), num)
+        self.assertEqual(d.stats(reset=1)["counters"], st["counters"])
+        self.assertEqual(d.stats()["ops"], {})
+
+        # Sorted lists count the bisects and the splits
+        d = Fastlist(load=4, sorted=1, stats=1)
+        d.insort_many([5, 1, 3])
+        for i in range(20):
+            d.insort(i)
+        st = d.stats()
+        self.assertTrue(st["counters"]["bisects"] >= 20)
+        self.assertTrue(st["counters"]["splits"] > 0)
+        self.assertEqual(st["ops"]["insort"][0], 20)
+        self.assertTrue(isinstance(d.union(d), Fastlist))
+        self.assertEqual(d.snapshot().stats()["counters"], {})
+
+        # Disabled statistics keep the plain class, pickles drop them
+        d = Fastlist([1, 2], stats=0)
+        self.assertIs(type(d), Fastlist)
+        self.assertEqual(d.stats()["counters"], {})
+        e = pickle.loads(pickle.dumps(Fastlist([1, 2], stats=1)))
+        self.assertIs(type(e), Fastlist)
+        self.assertEqual(e.as_list(), [1, 2])
+
+    def test_Fastlist_class__head_ops(self):
+        """ Head operations move the head offset, not every start """
+        d = Fastlist([], load=4)
+        q = collections.deque()
+        for i in range(200):
+            if i % 3 == 2:
+                self.assertEqual(d.popleft(), q.popleft())
+            elif i % 3:
+                d.appendleft(i)
+                q.appendleft(i)
+            else:
+                d.append(i)
+                q.append(i)
+            self.assertEqual(d[len(q) // 2], q[len(q) // 2])
+        self.assertEqual(d.as_list(), list(q))
+        self.assertEqual(d._true_starts(),
+                         [sum(map(len, d._lists[:j]))
+                          for j in range(len(d._lists))])
+
+        # Front pops fix up a bounded number of starts whatever the size
+        for n in [100, 10000]:
+            d = Fastlist(range(n), load=10, stats=1)
+            for i in range(50):
+                self.assertEqual(d.pop(0), i)
+            self.assertTrue(d.stats()["counters"]["starts_fixups"] < 200)
+            self.assertEqual(d[0], 50)
+            self.assertEqual(len(d), n - 50)
+
+    def test_Fastlist_class__hashed(self):
+        """ Hash index for the unsorted membership, index and count """
+        for hashed in [0, 1]:
+            d = Fastlist([], load=3, hashed=hashed)
+            l = []
+            for i in range(300):
+                x = random.randint(0, 30)
+                sel = random.randint(0, 5)
+                if sel == 0 and l:
+                    j = random.randint(0, len(l) - 1)
+                    self.assertEqual(d.pop(j), l.pop(j))
+                elif sel == 1 and l:
+                    j = random.randint(0, len(l) - 1)
+                    d.insert(j, x)
+                    l.insert(j, x)
+                elif sel == 2 and l:
+                    j = random.randint(0, len(l) - 1)
+                    d[j] = x
+                    l[j] = x
+                elif sel == 3 and l:
+                    (a, b) = sorted(random.sample(range(len(l) + 1), 2))
+                    d[a:b] = [x] * (b - a + 1)
+                    l[a:b] = [x] * (b - a + 1)
+                elif sel == 4:
+                    d.appendleft(x)
+                    l.insert(0, x)
+                else:
+                    d.extend([x, x + 1])
+                    l.extend([x, x + 1])
+                y = random.randint(0, 35)
+                self.assertEqual(y in d, y in l)
+                self.assertEqual(d.count(y), l.count(y))
+                if y in l:
+                    self.assertEqual(d.index(y), l.index(y))
+                else:
+                    self.assertRaises(ValueError, d.index, y)
+            self.assertEqual(d.as_list(), l)
+            if hashed:
+                self.assertEqual(d._token_pos(), {
+                    t: il for (il, t) in enumerate(d._tokens)})
+                self.assertEqual(len(d._tokens), len(d._lists))
+
+        # Index survives snapshots and dumps, sorted lists can't have it
+        e = pickle.loads(pickle.dumps(d))
+        s = d.snapshot()
+        s.append(99)
+        self.assertTrue(99 in s and 99 not in d and 99 not in e)
+        self.assertEqual(e.index(l[-1]), l.index(l[-1]))
+        self.assertRaises(RuntimeError, Fastlist, [], sorted=1, hashed=1)
+
+        # Unhashable items fail before the list changes
+        d = Fastlist(range(5), load=2, hashed=1)
+        for update in [lambda: d.insert(1, [9]), lambda: d.append([9]),
+                       lambda: d.extend([7, [9]]), lambda: d.appendleft([9]),
+                       lambda: d.__setitem__(1, [9]),
+                       lambda: d.__setitem__(slice(1, 3), [7, [9]]),
+                       lambda: d.__setitem__(slice(0, 4, 2), [7, [9]])]:
+            self.assertRaises(TypeError, update)
+            self.assertEqual(d.as_list(), list(range(5)))
+            self.assertEqual(len(d), 5)
+            self.assertEqual(sorted(d._where), list(range(5)))
+        d = Fastlist(sorted=1)
+        d.insort_many([3, 1, 3])
+        self.assertEqual((d.count(3), d.index(3)), (2, 1))
+
+    def test_Fastlist_class__remove(self):
+        """ Sorted remove, discard, count and remove_range """
+        for key in [None, lambda v: v // 3]:
+            d = Fastlist(load=3, sorted=1, key=key)
+            l = []
+            for i in range(500):
+                x = random.randint(0, 40)
+                if random.randint(0, 2):
+                    d.insort(x)
+                    l.append(x)
+                elif x in l:
+                    d.remove(x)
+                    l.remove(x)
+                else:
+                    self.assertFalse(d.discard(x))
+                    self.assertRaises(ValueError, d.remove, x)
+                y = random.randint(0, 40)
+                self.assertEqual(d.count(y), l.count(y))
+            self.assertEqual(sorted(d.as_list()), sorted(l))
+
+        # Ranges of keys, whole sublists in between are dropped
+        d = Fastlist(load=4, sorted=1)
+        d.insort_many(range(100))
+        d.remove_range(10, 20)
+        self.assertEqual(len(d), 90)
+        self.assertEqual(d[9:11], [9, 20])
+        d.remove_range(30, 40, inclusive=(False, True))
+        self.assertEqual(d[19:21], [29, 30])
+        self.assertEqual(d[21], 41)
+        d.remove_range(hi=5)
+        d.remove_range(95)
+        self.assertEqual((d[0], d[-1]), (5, 94))
+        d.remove_range(50, 40)
+        self.assertEqual(d.count(45), 1)
+        d.remove_range()
+        self.assertEqual(len(d), 0)
+        d.remove_range(1, 2)
+
+    def test_Fastlist_class__adaptive(self):
+        """ Adaptive load. Retuned with the size, re-chunked gradually """
+        d = Fastlist(adaptive=(8, 4096))
+        self.assertEqual(d._load, 4096)
+        l = []
+        for n in range(20000):
+            d.append(n)
+            l.append(n)
+        self.assertTrue(8 <= d._load <= 4096)
+        self.assertTrue(d._load < 2000)
+        self.assertEqual(d.as_list(), l)
+        for n in range(0, 19990, 2):
+            d.insert(n % len(d), n)
+            l.insert(n % len(l), n)
+            self.assertEqual(d.pop(n * 7 % len(d)), l.pop(n * 7 % len(l)))
+        self.assertEqual(d.as_list(), l)
+        load = d._load
+        while len(d) > 100:
+            d.pop()
+        self.assertTrue(d._load < load)
+        for n in range(64):
+            d.pop()
+        self.assertTrue(all(len(x) < d._load * 2 for x in d._lists))
+        self.assertEqual(d.as_list(), l[:36])
+
+        # Lookups count as index access, every update path is an update
+        d = Fastlist(range(1000), adaptive=(8, 4096))
+        (d._mix, d._tune) = ([0, 0, 0], 1000)
+        d.insert(5, 1)
+        d.pop(3)
+        d[7] = 2
+        d[1:7:2] = [0, 0, 0]
+        del(d[10:20])
+        d[30:31] = [1, 2]
+        d.cursor(50).iter_del()
+        self.assertEqual(d._mix, [0, 8, 0])
+        self.assertEqual(d[3] + len(d[5:9]), 4)
+        self.assertEqual(d._mix, [2, 8, 0])
+
+        """ Sorted list """
+        d = Fastlist(sorted=1, adaptive=1, load=10)
+        self.assertEqual(d._load, 64)
+        d.insort_many(range(0, 200000, 2))
+        for n in range(1, 20000, 2):
+            d.insort(n)
+        self.assertTrue(d._load > 64)
+        self.assertTrue(all(len(x) < d._load * 2 for x in d._lists))
+        self.assertEqual(d[:10], list(range(10)))
+        self.assertEqual(d.index(20000), 20000)
+
     def test_Fastlist_class__insort(self):
         """ Insort. Insert element in sorted order """
 
@@ -512,23 +4502,35 @@ class unitTests(unittest.TestCase):
         """ Sorted list """
         l = [(1, 0), (3, 0), (3, 0), (3, 0), (4, 0)]
         d = Fastlist(l, load=2, sorted=1)
-        d.lower_bound((3, 0))
-        self.assertEqual((d._il, d._ii), (0, 1))
-        d.upper_bound((3, 0))
-        self.assertEqual((d._il, d._ii), (2, 0))
-        d.upper_bound((0, 0))
-        self.assertEqual((d._il, d._ii), (0, 0))
-        d.lower_bound((5, 0))
-        self.assertEqual((d._il, d._ii), (2, 1))
+        it = d.lower_bound((3, 0))
+        self.assertEqual((it._il, it._ii), (0, 1))
+        it = d.upper_bound((3, 0))
+        self.assertEqual((it._il, it._ii), (2, 0))
+        it = d.upper_bound((0, 0))
+        self.assertEqual((it._il, it._ii), (0, 0))
+        it = d.lower_bound((5, 0))
+        self.assertEqual((it._il, it._ii), (2, 1))
+        self.assertTrue(it.iter_end())
 
     def test_Fastlist_class__setitem(self):
-        """ Setitem L[i] = k , L[i:j] is not supported  """
+        """ Setitem L[i] = k or L[i:j] = [] """
 
         # Assign value
         d = Fastlist([4, 2, 1, 5], load=2)
         d[2] = 5
         self.assertEqual(d.as_list(), [4, 2, 5, 5])
 
+        # Assign slice
+        d[1:3] = [7, 8, 9]
+        self.assertEqual(d.as_list(), [4, 7, 8, 9, 5])
+        d[::2] = [0, 0, 0]
+        self.assertEqual(d.as_list(), [0, 7, 0, 9, 0])
+        try:
+            d[::2] = [1]
+            self.assertTrue(0)
+        except ValueError:
+            pass
+
         # Check for empty list exception
         try:
             Fastlist(load=2)[0] = 1
@@ -593,12 +4595,10 @@ class unitTests(unittest.TestCase):
         # Allowed to read whole sorted array
         self.assertEqual(d[:], d.as_list())
 
-        # Not allowed any indexes other than 0 and -1
-        try:
-            self.assertEqual(d[1:3], 4)
-            self.assertTrue(0)
-        except RuntimeError:
-            pass
+        # Rank access
+        self.assertEqual(d[1], 2)
+        self.assertEqual(d[1:3], [2, 1])
+        self.assertEqual(d[::-2], [5, 2])
 
     def test_Fastlist_class__iadd(self):
         """ Inplace Add list L += [] """
@@ -630,8 +4630,61 @@ class unitTests(unittest.TestCase):
         del(d[0])
         del(d[-1])
         self.assertEqual(d.as_list(), [2, 3, 4, 5])
+        del(d[2:])
+        self.assertEqual(d.as_list(), [2, 3])
+
+    def test_Fastlist_class__slices(self):
+        """ Range deletion and slice assignment against a list """
+        stress = 300
+
+        for indexed in [0, 1]:
+            l = list(range(100))
+            d = Fastlist(l, load=5, indexed=indexed)
+            for i in range(stress):
+                a = random.randint(-len(l) - 2, len(l) + 2)
+                b = random.randint(-len(l) - 2, len(l) + 2)
+                step = random.choice([None, 1, 2, 3, 7, -1, -2])
+                data = [random.randint(0, 100)
+                        for n in range(random.randint(0, 20))]
+                sel = random.randint(0, 2)
+                if sel == 0:
+                    del(l[a:b:step])
+                    del(d[a:b:step])
+                elif sel == 1:
+                    if step not in (None, 1):
+                        data = data[:len(l[a:b:step])]
+                        data += [0] * (len(l[a:b:step]) - len(data))
+                    l[a:b:step] = data
+                    d[a:b:step] = data
+                elif sel == 2:
+                    l.extend(data)
+                    d.extend(data)
+                self.assertEqual(len(d), len(l))
+                self.assertEqual(d.as_list(), l)
+                if l:
+                    index = random.randint(-len(l), len(l) - 1)
+                    self.assertEqual(d[index], l[index])
+                if not indexed:
+                    starts = [sum(map(len, d._lists[:j]))
+                              for j in range(len(d._lists))]
+                    self.assertEqual(d._true_starts(), starts)
+                self.assertTrue(max(map(len, d._lists)) < 10)
+
+        # Time ordered buffer trimming drops whole sublists
+        d = Fastlist(range(1000), load=10)
+        del(d[:555])
+        self.assertEqual(d[0], 555)
+        self.assertEqual(len(d._lists), 45)
+
+        """ Sorted list """
+        l = sorted([random.randint(0, 100) for n in range(100)])
+        d = Fastlist(l, load=5, sorted=1)
+        del(d[10:60:3])
+        del(l[10:60:3])
+        self.assertEqual(d.as_list(), l)
+        self.assertEqual(d.index(l[50]), l.index(l[50]))
         try:
-            del(d[2:])
+            d[1:2] = [1]
             self.assertTrue(0)
         except RuntimeError:
             pass
@@ -775,6 +4828,80 @@ class unitTests(unittest.TestCase):
             self.assertEqual(data in d, data in l)
         self.assertEqual(list(d), sorted(l))
 
+    def test_Fastlist_class__indexed(self):
+        """ Indexed mode. Sublist lengths are kept in a Fenwick tree """
+        stress = 1000
+
+        l = [random.randint(0, 100) for n in range(20)]
+        d = Fastlist(l, load=5, indexed=1)
+        self.assertEqual(d._starts, [])
+        for i in range(stress):
+            sel = random.randint(0, 5)
+            index = random.randint(-len(l), len(l)-1) if l else 0
+            data = random.randint(0, 100)
+            if not l:
+                sel = 1
+            if sel == 0:
+                l.insert(index, data)
+                d.insert(index, data)
+            elif sel == 1:
+                l.append(data)
+                d.append(data)
+            elif sel == 2:
+                self.assertEqual(l.pop(index), d.pop(index))
+            elif sel == 3:
+                l[index] = data
+                d[index] = data
+            elif sel == 4:
+                self.assertEqual(d[index], l[index])
+            elif sel == 5:
+                del(l[index])
+                del(d[index])
+            self.assertEqual(len(d), len(l))
+        self.assertEqual(list(d), l)
+
+        # Iter delete keeps the tree in sync
+        d = Fastlist(range(10), load=2, indexed=1)
+        it = iter(d)
+        next(it)
+        it.iter_del()
+        self.assertEqual(d[1], 2)
+        self.assertEqual(len(d), 9)
+
+    def test_Fastlist_class__rank_select(self):
+        """ Rank and select. Index access to the sorted list """
+
+        l = sorted([random.randint(0, 50) for n in range(300)])
+        d = Fastlist(load=5, sorted=1)
+        for n in random.sample(l, len(l)):
+            d.insort(n)
+        self.assertEqual(len(d), len(l))
+        for k in range(len(l)):
+            self.assertEqual(d[k], l[k])
+        for n in set(l):
+            self.assertEqual(d.index(n), l.index(n))
+        self.assertEqual(d[10:200:3], l[10:200:3])
+        self.assertEqual(d[-5:], l[-5:])
+
+        # Percentiles and k-th smallest
+        self.assertEqual(d[len(d) // 2], l[len(l) // 2])
+        self.assertEqual(d[len(d) * 9 // 10], l[len(l) * 9 // 10])
+
+        # Pop by rank
+        while l:
+            k = random.randint(0, len(l) - 1)
+            self.assertEqual(d.pop(k), l.pop(k))
+            self.assertEqual(len(d), len(l))
+
+        # Absent values
+        d = Fastlist([1, 3, 5], load=2, sorted=1)
+        for n in [0, 2, 6]:
+            try:
+                d.index(n)
+                self.assertTrue(0)
+            except ValueError:
+                pass
+
     def test_Fastlist_class__iterators(self):
         """ Iterator functions """
 
@@ -839,6 +4966,472 @@ class unitTests(unittest.TestCase):
         except StopIteration:
             pass
 
+    def test_Fastlist_class__key(self):
+        """ Key function. Sorted by cached keys """
+
+        # Key function needs the sorted list
+        try:
+            Fastlist(key=abs)
+            self.assertTrue(0)
+        except RuntimeError:
+            pass
+
+        # Records ordered by a field, integer keys in an array
+        for keybase in [list, Arrq]:
+            l = [(random.randint(0, 50), str(n)) for n in range(50)]
+            d = Fastlist(load=4, sorted=1, key=lambda r: r[0],
+                         keybase=keybase)
+            for r in l:
+                d.insort(r)
+            l.sort(key=lambda r: r[0])
+            self.assertEqual(d.as_list(), l)
+            self.assertEqual({type(k) is list for k in d._keys},
+                             {keybase is list})
+            self.assertEqual(list(d._mins), [k[0] for k in d._keys])
+            for i in range(200):
+                r = (random.randint(0, 60), str(i))
+                sel = random.randint(0, 3)
+                if sel == 0:
+                    d.insort(r)
+                    l.insert(len([n for n in l if n[0] <= r[0]]), r)
+                elif sel == 1 and l:
+                    index = random.randint(0, len(l) - 1)
+                    self.assertEqual(d.pop(index), l.pop(index))
+                elif sel == 2:
+                    batch = [(random.randint(0, 60), str(i) + str(n))
+                             for n in range(random.randint(0, 10))]
+                    d += batch
+                    l = sorted(l + batch, key=lambda r: r[0])
+                elif sel == 3:
+                    del(d[10:20:3])
+                    del(l[10:20:3])
+                self.assertEqual(d.as_list(), l)
+                self.assertEqual(
+                    [list(k) for k in d._keys],
+                    [[r[0] for r in s] for s in d._lists])
+            for r in l:
+                self.assertTrue(r in d)
+                self.assertEqual(d.index(r), l.index(r))
+            self.assertFalse((10, "x") in d)
+            it = d.lower_bound((30, ""))
+            self.assertEqual(it.index(), len([r for r in l if r[0] < 30]))
+
+    def test_Segtree_class__basic_functionality(self):
+        """ Segtree class range queries """
+        l = [str(i) for i in range(13)]
+        t = Segtree(l, operator.add)
+        for i in range(len(l)):
+            for j in range(i + 1, len(l) + 1):
+                self.assertEqual(t.query(i, j), "".join(l[i:j]))
+        self.assertTrue(t.query(3, 3) is _EMPTY)
+        t.set(5, "x")
+        self.assertEqual(t.query(4, 7), "4x6")
+
+    def test_Fastlist_class__aggregate(self):
+        """ Aggregates of sublists for range queries """
+        stress = 300
+
+        for indexed in [0, 1]:
+            l = [random.randint(0, 100) for n in range(50)]
+            d = Fastlist(l, load=4, indexed=indexed)
+            for name in ["sum", "min", "max", "count"]:
+                d.add_aggregate(name)
+            d.add_aggregate("cat", lambda a, b: a + b,
+                            lambda s: "".join(map(str, s)))
+            for i in range(stress):
+                index = random.randint(-len(l), len(l) - 1) if l else 0
+                data = random.randint(0, 100)
+                sel = random.randint(0, 6)
+                if not l:
+                    sel = 1
+                if sel == 0:
+                    l.insert(index, data)
+                    d.insert(index, data)
+                elif sel == 1:
+                    l.append(data)
+                    d.append(data)
+                elif sel == 2:
+                    self.assertEqual(l.pop(index), d.pop(index))
+                elif sel == 3:
+                    l[index] = data
+                    d[index] = data
+                elif sel == 4:
+                    del(l[index:index+7])
+                    del(d[index:index+7])
+                elif sel == 5:
+                    l[index:index] = [data] * 9
+                    d[index:index] = [data] * 9
+                elif sel == 6:
+                    l.extend([data] * 5)
+                    d.extend([data] * 5)
+                a = random.randint(0, len(l))
+                b = random.randint(0, len(l))
+                part = l[a:b]
+                self.assertEqual(d.aggregate("sum", a, b, 0), sum(part))
+                self.assertEqual(d.aggregate("count", a, b, 0), len(part))
+                self.assertEqual(d.aggregate("min", a, b), min(part or [None]))
+                self.assertEqual(d.aggregate("max", a, b), max(part or [None]))
+                self.assertEqual(d.aggregate("cat", a, b, ""),
+                                 "".join(map(str, part)))
+            self.assertEqual(d.aggregate("sum"), sum(l))
+
+        """ Sorted list """
+        l = sorted([random.randint(0, 1000) for n in range(300)])
+        d = Fastlist(load=8, sorted=1)
+        d.add_aggregate("sum")
+        d += l
+        for i in range(50):
+            d.insort(i * 20)
+            l = sorted(l + [i * 20])
+            lo = random.randint(-10, 1010)
+            hi = random.randint(lo, 1010)
+            self.assertEqual(d.aggregate_range("sum", lo, hi, 0),
+                             sum([n for n in l if lo <= n < hi]))
+        d.clear()
+        self.assertEqual(d.aggregate("sum"), None)
+        d.insort(5)
+        self.assertEqual(d.aggregate_range("sum", 0, 10), 5)
+
+    def test_Fastlist_class__irange(self):
+        """ Irange and islice lazy iterators """
+
+        l = sorted([random.randint(0, 100) for n in range(200)])
+        d = Fastlist(l, load=6, sorted=1)
+        for i in range(100):
+            lo = random.randint(-5, 105)
+            hi = random.randint(-5, 105)
+            for inc in [(True, False), (True, True), (False, False),
+                        (False, True)]:
+                lok = [n >= lo if inc[0] else n > lo for n in l]
+                hik = [n <= hi if inc[1] else n < hi for n in l]
+                r = [n for (n, a, b) in zip(l, lok, hik) if a and b]
+                self.assertEqual(list(d.irange(lo, hi, inc)), r)
+                self.assertEqual(list(d.irange(lo, hi, inc, reverse=1)),
+                                 r[::-1])
+            self.assertEqual(list(d.irange(lo)), [n for n in l if n >= lo])
+            self.assertEqual(list(d.irange(hi=hi)), [n for n in l if n < hi])
+
+            a = random.randint(-210, 210)
+            b = random.randint(-210, 210)
+            self.assertEqual(list(d.islice(a, b)), l[a:b])
+            self.assertEqual(list(d.islice(a, b, reverse=1)), l[a:b][::-1])
+        self.assertEqual(list(d.islice()), l)
+
+        # Lazy generator
+        it = d.irange(10)
+        self.assertEqual(next(it), min([n for n in l if n >= 10]))
+
+        # Unsorted list slices
+        d = Fastlist(range(50), load=4)
+        self.assertEqual(list(d.islice(7, 23)), list(range(7, 23)))
+        try:
+            d.irange(1, 2)
+            self.assertTrue(0)
+        except RuntimeError:
+            pass
+
+    def test_Fastlist_class__set_operations(self):
+        """ Merge and set operations of sorted lists """
+
+        def counted(l):
+            return {n: l.count(n) for n in l}
+
+        def expand(c):
+            return sorted(sum([[n] * c[n] for n in c if c[n] > 0], []))
+
+        for (na, nb) in [(0, 0), (50, 0), (100, 80), (300, 3), (2, 300)]:
+            a = [random.randint(0, 40) for n in range(na)]
+            b = [random.randint(0, 40) for n in range(nb)]
+            da = Fastlist(sorted(a), load=7, sorted=1)
+            db = Fastlist(sorted(b), load=5, sorted=1)
+            (ca, cb) = (counted(a), counted(b))
+            keys = set(a) | set(b)
+            expect = {
+                "merge": sorted(a + b),
+                "union": expand({n: max(ca.get(n, 0), cb.get(n, 0))
+                                 for n in keys}),
+                "intersection": expand({n: min(ca.get(n, 0), cb.get(n, 0))
+                                        for n in keys}),
+                "difference": expand({n: ca.get(n, 0) - cb.get(n, 0)
+                                      for n in keys}),
+                "symmetric_difference": expand(
+                    {n: abs(ca.get(n, 0) - cb.get(n, 0)) for n in keys})}
+            for name in expect:
+                d = getattr(da, name)(db)
+                self.assertEqual(d.as_list(), expect[name])
+                self.assertEqual(len(d), len(expect[name]))
+                self.assertEqual(list(d._mins),
+                                 [s[0] for s in d._lists if s])
+                self.assertTrue(max(map(len, d._lists), default=0) < 14)
+                if len(d._lists) > 1:
+                    self.assertTrue(min(map(len, d._lists)) > 7 * 0.2)
+                d.insort(20)
+                self.assertEqual(d.index(20), sorted(
+                    expect[name] + [20]).index(20))
+
+        # Sublists out of the reach of the other list are copied whole
+        da = Fastlist(range(100), load=10, sorted=1, base=Arrq)
+        d = da.union(Fastlist([50, 50, 120], load=4, sorted=1))
+        self.assertEqual(d.as_list(), sorted(list(range(100)) + [50, 120]))
+        self.assertEqual(d._lists[0], da._lists[0])
+        self.assertIsNot(d._lists[0], da._lists[0])
+        self.assertEqual(d._lists[-1].typecode, "q")
+
+        # Interleaved lists combine into balanced sublists
+        da = Fastlist(range(0, 2000, 2), load=10, sorted=1)
+        db = Fastlist(range(1, 2000, 2), load=10, sorted=1)
+        for d in [da.merge(db), da.union(db)]:
+            self.assertEqual(d.as_list(), list(range(2000)))
+            self.assertTrue(all(2 <= len(s) < 20 for s in d._lists))
+
+        # Key function
+        a = Fastlist([(1, "a"), (2, "b"), (2, "c")], sorted=1,
+                     key=lambda r: r[0])
+        b = Fastlist([(2, "x"), (3, "y")], sorted=1, key=lambda r: r[0])
+        self.assertEqual(a.merge(b).as_list(),
+                         [(1, "a"), (2, "b"), (2, "c"), (2, "x"), (3, "y")])
+        self.assertEqual(a.difference(b).as_list(), [(1, "a"), (2, "b")])
+
+        # Sorted lists only
+        try:
+            Fastlist([1]).union(Fastlist([2]))
+            self.assertTrue(0)
+        except RuntimeError:
+            pass
+
+    def test_Fastlist_class__many(self):
+        """ Batched bisect, count and contains """
+        bases = [list, Arrl, Arrq] + ([Npq] if numpy is not None else [])
+        for base in bases:
+            l = sorted([random.randint(0, 200) for n in range(400)])
+            d = Fastlist(l, load=9, sorted=1, base=base)
+            d += [100] * 20
+            l = sorted(l + [100] * 20)
+            probes = [random.randint(-10, 210) for n in range(300)] + [100]
+            self.assertEqual(d.bisect_many(probes),
+                             [bisect.bisect_left(l, n) for n in probes])
+            self.assertEqual(d.bisect_many(probes, right=1),
+                             [bisect.bisect_right(l, n) for n in probes])
+            self.assertEqual(d.count_many(probes),
+                             [l.count(n) for n in probes])
+            self.assertEqual(d.contains_many(probes),
+                             [n in l for n in probes])
+            self.assertEqual(d.bisect_many([]), [])
+
+        # Empty list
+        d = Fastlist(sorted=1)
+        self.assertEqual(d.count_many([1, 2]), [0, 0])
+
+        # Key function
+        d = Fastlist([(1, "a"), (2, "b"), (2, "c")], sorted=1,
+                     key=lambda r: r[0])
+        self.assertEqual(d.count_many([2, 1, 3]), [2, 1, 0])
+
+    def test_Fastlist_class__snapshot(self):
+        """ Snapshot. Copy on write of the shared sublists """
+
+        l = list(range(100))
+        d = Fastlist(l, load=4)
+        d.add_aggregate("sum")
+        s = d.snapshot()
+        self.assertEqual(s.as_list(), l)
+        self.assertTrue(all(a is b for (a, b) in zip(d._lists, s._lists)))
+
+        # Every kind of update on either side stays private
+        for (a, b) in [(d, s), (s, d)]:
+            a.insert(50, -1)
+            a.append(-2)
+            a.extend([-3, -4])
+            a.pop(10)
+            a[20] = -5
+            del(a[30:40:3])
+            a[60:62] = [-6, -7, -8]
+            del(a[:5])
+            self.assertEqual(b.as_list(), l)
+            self.assertEqual(b.aggregate("sum"), sum(l))
+            self.assertEqual(len(b), len(l))
+            l = a.as_list()
+
+        # Snapshot of a snapshot, untouched sublists stay shared
+        d = Fastlist(range(100), load=10)
+        s1 = d.snapshot()
+        s2 = s1.snapshot()
+        d.append(100)
+        s1.pop(0)
+        self.assertEqual(s2.as_list(), list(range(100)))
+        self.assertEqual(d.as_list(), list(range(101)))
+        self.assertEqual(s1.as_list(), list(range(1, 100)))
+        self.assertTrue(d._lists[5] is s2._lists[5])
+
+        """ Sorted list """
+        for key in [None, lambda n: -n]:
+            l = sorted(range(100), key=key)
+            d = Fastlist(l, load=4, sorted=1, key=key)
+            s = d.snapshot()
+            for n in range(30):
+                d.insort(n)
+            d += [5, 6]
+            del(d[10:20])
+            d.pop(3)
+            self.assertEqual(s.as_list(), l)
+            self.assertEqual(s.index(50), l.index(50))
+            s.insort(7)
+            self.assertEqual(s.as_list(), sorted(l + [7], key=key))
+
+    def test_Fastlist_class__cursor(self):
+        """ Cursor. Independent iterators over one list """
+
+        # Nested iteration
+        d = Fastlist(range(10), load=3)
+        pairs = [(a, b) for a in d for b in d]
+        self.assertEqual(len(pairs), 100)
+        self.assertEqual(pairs[-1], (9, 9))
+
+        # Reversed iteration does not stick to the list
+        self.assertEqual(list(reversed(d)), list(range(9, -1, -1)))
+        self.assertEqual(list(d), list(range(10)))
+
+        # Cursor at index, forward and backward steps
+        it = d.cursor(5)
+        self.assertEqual(it.iter_getitem(), 5)
+        self.assertEqual(it.move(-3).iter_getitem(), 2)
+        self.assertEqual(it.move(4).index(), 6)
+        self.assertEqual(list(d.cursor(7, reverse=1)), list(range(7, -1, -1)))
+        self.assertEqual(list(d.cursor(len(d))), [])
+
+        # Delete and insert at the cursor
+        d = Fastlist(range(40), load=3)
+        it = iter(d)
+        while not it.iter_end():
+            if it.iter_getitem() % 2:
+                it.iter_del()
+            else:
+                it.iter_insert(-1)
+                next(it)
+        self.assertEqual(d.as_list(), sum([[-1, i] for i in range(0, 40, 2)],
+                                          []))
+
+        it = reversed(d)
+        while not it.iter_end():
+            if it.iter_getitem() == -1:
+                it.iter_del()
+            else:
+                next(it)
+        self.assertEqual(d.as_list(), list(range(0, 40, 2)))
+
+        # Revalidation after structural changes elsewhere in the list
+        for indexed in [0, 1]:
+            d = Fastlist(range(100), load=4, indexed=indexed)
+            it = d.cursor(50)
+            d.extend(range(100))
+            for i in range(30):
+                d.insert(60, i)
+            del(d[70:])
+            self.assertEqual(it.iter_getitem(), 50)
+            self.assertEqual(next(it), 50)
+            self.assertEqual(next(it), 51)
+
+        # Two cursors updating the same list keep to their items
+        d = Fastlist(range(40), load=4)
+        a = d.cursor(20)
+        b = d.cursor(0)
+        seen = []
+        for i in range(6):
+            b.iter_del()
+            seen.append(next(a))
+        self.assertEqual(seen, list(range(20, 26)))
+        self.assertEqual((a.index(), b.index()), (20, 0))
+        b.move(12).iter_insert(-1)
+        a.iter_del()
+        self.assertEqual((next(a), next(b)), (27, 18))
+        d = Fastlist(range(10), load=3)
+        c = d.cursor(5)
+        r = d.cursor(5, reverse=1)
+        for x in range(3):
+            d.insert(0, -1)
+        del d[6:8]
+        self.assertEqual(list(c), [5, 6, 7, 8, 9])
+        self.assertEqual(list(r), [5, 2, 1, 0, -1, -1, -1])
+
+        """ Sorted list """
+        d = Fastlist([1, 2, 2, 2, 2, 3, 4], load=2, sorted=1)
+        a = d.lower_bound(2)
+        b = d.upper_bound(2)
+        self.assertEqual((a.index(), b.index()), (1, 5))
+        self.assertEqual(next(a), 2)
+        self.assertEqual(next(b), 3)
+        self.assertEqual(d.iter_getitem(), 4)
+        try:
+            a.iter_insert(2)
+            self.assertTrue(0)
+        except RuntimeError:
+            pass
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_Nparr_class__basic_functionality(self):
+        """ Nparr class list interface """
+        for base in [Npq, Npd]:
+            l = [3, 1, 2]
+            a = base(l)
+            for i in range(50):
+                n = random.randint(0, 100)
+                index = random.randint(-len(l), len(l))
+                sel = random.randint(0, 5)
+                if sel == 0:
+                    a.insert(index, n)
+                    l.insert(index, n)
+                elif sel == 1 and l:
+                    index = random.randint(-len(l), len(l) - 1)
+                    self.assertEqual(a.pop(index), l.pop(index))
+                elif sel == 2:
+                    a.append(n)
+                    l.append(n)
+                elif sel == 3:
+                    a += [n, n + 1]
+                    l += [n, n + 1]
+                elif sel == 4:
+                    del(a[1:index:2])
+                    del(l[1:index:2])
+                elif sel == 5:
+                    a[index:index+1] = base([n, n])
+                    l[index:index+1] = [n, n]
+                self.assertEqual(list(a), l)
+                self.assertEqual(len(a), len(l))
+            self.assertEqual(list(a[1:4] + base([7])), l[1:4] + [7])
+            self.assertEqual(type(a[0]), int if base is Npq else float)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_Numlist_class__basic_functionality(self):
+        """ Numlist sorted engine with vectorized bulk operations """
+        l = [random.randint(0, 1000) for n in range(500)]
+        d = Numlist(l, load=16)
+        l.sort()
+        self.assertEqual(d.as_list(), l)
+        for batch in [[5], [random.randint(-50, 1050) for n in range(300)]]:
+            d.insort_many(batch)
+            l = sorted(l + batch)
+            self.assertEqual(d.as_list(), l)
+            self.assertTrue(max(map(len, d._lists)) < 32)
+        d.insort(500)
+        d.pop(100)
+        l = sorted(l + [500])
+        l.pop(100)
+        self.assertEqual(d.to_numpy().tolist(), l)
+        self.assertEqual(d[len(l) // 2], l[len(l) // 2])
+        self.assertEqual(d.index(l[200]), l.index(l[200]))
+        for (lo, hi) in [(0, 1000), (100, 900), (400, 410), (500, 400),
+                         (-100, 0), (2000, 3000)]:
+            self.assertEqual(d.count_range(lo, hi),
+                             len([n for n in l if lo <= n < hi]))
+            self.assertEqual(d.sum_range(lo, hi),
+                             sum([n for n in l if lo <= n < hi]))
+
+        # Float timestamps
+        d = Numlist([0.5, 0.25, 2.0], load=2, base=Npd)
+        d += [1.5, 0.75]
+        self.assertEqual(d.as_list(), [0.25, 0.5, 0.75, 1.5, 2.0])
+        self.assertEqual(d.sum_range(0.5, 1.5), 1.25)
+
     def test_Fastlist_class__array(self):
         """ Using array as a base class """
 
@@ -860,3 +5453,4 @@ class unitTests(unittest.TestCase):
 if __name__ == "__main__":
     if sys.argv[-1] == "-ut":
         unittest.main(argv=[" "])
+    sys.exit(main())